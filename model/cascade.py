@@ -0,0 +1,171 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform as transform_coords
+from rasterio.windows import bounds as window_bounds
+from scipy import ndimage
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from dataloader import GenMARSHWindows, RUN_MODEL, SKIP_NON_MARSH
+from inference import load_inference_model, make_dataloader, run_window_inference
+
+
+def sentinel_candidates(probability_path: Path, threshold: float = 0.3, margin: int = 3):
+    """
+    Candidate marsh areas of the Sentinel probability map: the pixels with a marsh probability of at least
+    threshold, and the pixels without a coarse prediction (nodata, e.g. empty windows or granule edge gaps),
+    dilated by margin pixels so the marsh edges missed at 10 m are still covered.
+
+    :return: boolean candidate mask and the profile of the Sentinel grid
+    """
+    with rasterio.open(probability_path) as src:
+        probability = src.read(1)
+        profile = src.profile.copy()
+
+    candidates = probability >= threshold
+    if profile["nodata"] is not None:
+        candidates |= probability == profile["nodata"]
+    if margin > 0:
+        candidates = ndimage.binary_dilation(candidates, structure=np.ones((3, 3), dtype=bool), iterations=margin)
+
+    print(f"[INFO] Candidate marsh area: {candidates.mean() * 100:.1f}% of the Sentinel grid")
+    return candidates, profile
+
+
+def candidate_table(candidates: np.ndarray) -> np.ndarray:
+    """
+    Summed-area table of the candidate mask: the number of candidate pixels in any rectangle comes from four
+    lookups. Built once and shared by all the NAIP tiles; int32 is enough for a Sentinel tile (10980^2 pixels).
+    """
+    height, width = candidates.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.cumsum(candidates, axis=0, dtype=np.int32, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def candidate_window_codes(dataset: GenMARSHWindows, table: np.ndarray, candidate_profile: dict):
+    """
+    Skip codes of the windows of a NAIP dataset: RUN_MODEL for the windows intersecting a candidate area,
+    SKIP_NON_MARSH for the others. The window corners are transformed onto the Sentinel grid through the
+    geotransforms and CRSs of both rasters, and the intersection is looked up in the summed-area table of the
+    candidate mask (see candidate_table). Windows outside the Sentinel grid are kept, there is no coarse
+    prediction there.
+    """
+    windows = dataset.windows
+    profile = dataset.profile
+
+    # Corners of every window in the NAIP CRS, transformed to the Sentinel CRS in one call
+    corners_x, corners_y = [], []
+    for window in windows:
+        left, bottom, right, top = window_bounds(window, profile["transform"])
+        corners_x.extend([left, right, left, right])
+        corners_y.extend([top, top, bottom, bottom])
+    xs, ys = transform_coords(profile["crs"], candidate_profile["crs"], corners_x, corners_y)
+    xs = np.array(xs).reshape(-1, 4)
+    ys = np.array(ys).reshape(-1, 4)
+
+    # Pixel extent of every window on the Sentinel grid
+    inverse = ~candidate_profile["transform"]
+    cols_a, rows_a = inverse * (xs.min(axis=1), ys.max(axis=1))
+    cols_b, rows_b = inverse * (xs.max(axis=1), ys.min(axis=1))
+    col_start = np.floor(np.minimum(cols_a, cols_b)).astype(int)
+    col_stop = np.ceil(np.maximum(cols_a, cols_b)).astype(int)
+    row_start = np.floor(np.minimum(rows_a, rows_b)).astype(int)
+    row_stop = np.ceil(np.maximum(rows_a, rows_b)).astype(int)
+
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    outside = (col_stop <= 0) | (row_stop <= 0) | (col_start >= width) | (row_start >= height)
+    col_start, col_stop = np.clip(col_start, 0, width), np.clip(col_stop, 0, width)
+    row_start, row_stop = np.clip(row_start, 0, height), np.clip(row_stop, 0, height)
+
+    # Number of candidate pixels in every window from four lookups
+    counts = (table[row_stop, col_stop] - table[row_start, col_stop]
+              - table[row_stop, col_start] + table[row_start, col_start])
+
+    return np.where(outside | (counts > 0), RUN_MODEL, SKIP_NON_MARSH)
+
+
+def run_cascade(sentinel_raster: Path, sentinel_checkpoint: Path, naip_tiles, naip_checkpoint: Path,
+                sentinel_probability: Path, output_dir: Path, threshold: float = 0.3, margin: int = 3,
+                batch_size: int = 32, num_workers: int = 4, writer_workers: int = 2, model_options: dict = None) -> None:
+    """
+    Coarse-to-fine inference: the Sentinel model runs over the AOI first, then the NAIP model only runs on the
+    NAIP windows intersecting the dilated Sentinel marsh candidates; the other windows are written as non-marsh.
+
+    :param sentinel_raster: combined Sentinel raster of the AOI
+    :param naip_tiles: raw NAIP tiles covered by the AOI
+    :param sentinel_probability: Sentinel marsh probability map, reused if it already exists
+    :param output_dir: folder of the NAIP predictions, one per tile
+    :param threshold: marsh probability from which a Sentinel pixel is a candidate
+    :param margin: dilation of the candidate areas, in Sentinel pixels
+    """
+    model_options = model_options or {}
+    sentinel_probability = Path(sentinel_probability)
+
+    if sentinel_probability.is_file():
+        print(f"[INFO] Reusing the Sentinel probability map: {sentinel_probability}")
+    else:
+        dataset = GenMARSHWindows(sentinel_raster, patch_size=128, overlap=10, mode="test")
+        model, device = load_inference_model(sentinel_checkpoint, dataset, batch_size=batch_size, **model_options)
+        run_window_inference(model, make_dataloader(dataset, batch_size, num_workers), sentinel_probability,
+                             device, writer_workers=writer_workers, output="probability")
+
+    candidates, candidate_profile = sentinel_candidates(sentinel_probability, threshold, margin)
+    table = candidate_table(candidates)
+    del candidates
+
+    model = None
+    for tile in naip_tiles:
+        tile = Path(tile)
+        dataset = GenMARSHWindows(tile, patch_size=256, overlap=30, ndwi=False, datasource="NAIP")
+        codes = candidate_window_codes(dataset, table, candidate_profile)
+        dataset.preset_codes(codes)
+        print(f"[INFO] {tile.name}: {int((codes == RUN_MODEL).sum())} of {len(codes)} windows are candidates")
+
+        if model is None:
+            model, device = load_inference_model(naip_checkpoint, dataset, batch_size=batch_size, **model_options)
+        run_window_inference(model, make_dataloader(dataset, batch_size, num_workers),
+                             Path(output_dir) / f"cascade_{tile.stem}.tif", device, writer_workers=writer_workers)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sentinel to NAIP cascade marsh inference.")
+    parser.add_argument("--aoi", type=str, default="aoi", help="AOI name used in the Sentinel preprocessing step")
+    parser.add_argument("--sentinel-year", type=str, default="2018", help="Year of the Sentinel imagery")
+    parser.add_argument("--naip-year", type=str, default="2022", help="Year of the NAIP imagery")
+    parser.add_argument("--tiles", type=str, nargs="*", default=None,
+                        help="NAIP tile names, defaults to all the tiles in dataset/raw/NAIP/<naip year>")
+    parser.add_argument("--threshold", type=float, default=0.3, help="Sentinel marsh probability of the candidates")
+    parser.add_argument("--margin", type=int, default=3, help="Dilation of the candidate areas in Sentinel pixels")
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of windows per batch")
+    parser.add_argument("--num-workers", type=int, default=4, help="Number of DataLoader processes")
+    parser.add_argument("--writer-workers", type=int, default=2, help="Number of threads writing the predictions")
+    parser.add_argument("--fast", action="store_true", help="Compiled, channels-last PyTorch model")
+
+    args = parser.parse_args()
+
+    dataset_root = project_root / "dataset"
+    naip_dir = dataset_root / "raw" / "NAIP" / args.naip_year
+    tiles = [naip_dir / f"{name}.tif" for name in args.tiles] if args.tiles else sorted(naip_dir.glob("*.tif"))
+
+    run_cascade(
+        sentinel_raster=dataset_root / "processed" / f"sentinel_{args.aoi}_{args.sentinel_year}" / f"combined_{args.aoi}_{args.sentinel_year}.tif",
+        sentinel_checkpoint=project_root / "weights" / "sentinel" / "unet" / "last.ckpt",
+        naip_tiles=tiles,
+        naip_checkpoint=project_root / "weights" / "naip" / "unet" / "last.ckpt",
+        sentinel_probability=dataset_root / "predicted" / "sentinel" / f"probability_{args.aoi}_{args.sentinel_year}.tif",
+        output_dir=dataset_root / "predicted" / "NAIP",
+        threshold=args.threshold,
+        margin=args.margin,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        writer_workers=args.writer_workers,
+        model_options={"fast": args.fast}
+    )
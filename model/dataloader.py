@@ -4,92 +4,424 @@ import torch
 import random
 import numpy as np
 import rasterio
+import pandas as pd
+import json
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.windows import Window
 from torch.utils.data import Dataset
 import os
 from pathlib import Path
+import sys
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+# The patch store layout and the valid pixel test are shared with the patch generation
+from processing.util import PATCH_STORE_ARRAY, PATCH_STORE_META, PATCH_INDEX, valid_fraction
 
 random.seed(0)
 np.random.seed(0)
 torch.manual_seed(0)
 
+# 'skip' entry of the samples: the windows flagged here are not sent to the model
+RUN_MODEL = 0
+SKIP_NODATA = 1      # written as nodata
+SKIP_WATER = 2       # written as non-marsh
+SKIP_NON_MARSH = 3   # written as non-marsh
+SKIP_NAMES = {SKIP_NODATA: "nodata", SKIP_WATER: "water", SKIP_NON_MARSH: "non-marsh"}
+
+
+def normalized_difference(a, b):
+    """(a - b) / (a + b), 0 where a + b is 0 (nodata or zero reflectance) instead of NaN/inf."""
+    total = a + b
+    return np.divide(a - b, total, out=np.zeros_like(total), where=total != 0)
+
+
+class SpectralGate:
+    """
+    Cheap pre-inference gate on the NDWI/NDVI of a window (after prepare_image), marking the windows whose
+    prediction is certain without the model: open water, which the post-processing masks out anyway, and
+    windows with almost no vegetation.
+
+    :param water_ndwi: NDWI from which a pixel is water (the post-processing threshold)
+    :param water_fraction: windows with at least this fraction of water pixels are certain water
+    :param vegetation_ndvi: NDVI from which a pixel is vegetated
+    :param vegetation_fraction: windows with a lower fraction of vegetated pixels are certain non-marsh
+    """
+
+    # Red band of the prepared image; green is band 1 and NIR band 3 for both sources
+    RED_BAND = {"naip": 0, "sentinel": 2}
+
+    def __init__(self, water_ndwi=0.5, water_fraction=0.95, vegetation_ndvi=0.2, vegetation_fraction=0.01):
+        self.water_ndwi = water_ndwi
+        self.water_fraction = water_fraction
+        self.vegetation_ndvi = vegetation_ndvi
+        self.vegetation_fraction = vegetation_fraction
+
+    def __call__(self, image, datasource="sentinel"):
+        green, nir = image[1], image[3]
+        red = image[self.RED_BAND[datasource.lower()]]
+
+        ndwi = normalized_difference(green, nir)
+        if (ndwi >= self.water_ndwi).mean() >= self.water_fraction:
+            return SKIP_WATER
+
+        ndvi = normalized_difference(nir, red)
+        if (ndvi >= self.vegetation_ndvi).mean() < self.vegetation_fraction:
+            return SKIP_NON_MARSH
+
+        return RUN_MODEL
+
+
+def prepare_image(image, mode="test", ndvi=True, ndwi=True, datasource="sentinel"):
+    """
+    Scale the raw band values, reorder the bands to match the training data and append the NDVI/NDWI features.
+
+    :param image: raw image array, CxHxW
+    :param mode: "train" for the original research data, "test" for the new processed data
+    :param ndvi: append the NDVI feature
+    :param ndwi: append the NDWI feature
+    :param datasource: "NAIP" or "sentinel"
+    :return: model input array, float32
+    """
+    image = image.astype('float32')
+
+    if datasource.lower() == 'naip':
+        image = image / 255.  # image = image/10000*3.5 (sentinel)
+    elif datasource.lower() == 'sentinel':
+        image = image / 10000
+    else:
+        raise ("The data source should be NAIP or sentinel")
+
+    if mode == "train":
+        # exclusing Coastal aerosol, Water vapour, and SWIR - Cirrus bands from analysis in Sentinel, since these bands are mainly for the atmospheric correction and cloud screen.
+        # 'RGBV' (B2, B3, B4, B8), 'B01'(Coastal aerosol), 'B05', 'B06', 'B07', 'B09'(Water vapour), 'B10' (SWIR - Cirrus), 'B11', 'B12', 'B8A' (in the original research data)
+        if datasource == 'sentinel':  # 5,9,10 (index: 4,8,9)
+            image = np.concatenate([image[:4, :, :], image[5:8, :, :], image[10:, :, :]], axis=0).astype('float32') #B2,3,4,8,5,6,7,11,12,B8A
+
+    elif mode == "test": # new processed data
+        if datasource == "sentinel":
+            # New sentinel data acquistion: band_list = ["02", "03", "04", "05", "06", "07", "08" ,"8A", "11", "12"]
+            # Change to B2,3,4,8,5,6,7,11,12,B8A
+            # make sure the testing data's band corresponds to the training data band
+            image = np.concatenate([
+                image[:3],
+                image[6][None, :, :],
+                image[3:6],
+                image[8:],
+                image[7][None, :, :]
+            ], axis=0).astype('float32')
+
+    if ndvi:
+        if datasource.lower() == 'naip':  # NAIP bands: R,G,B,NIR
+            ndvi_band = normalized_difference(image[3, :, :], image[0, :, :])  # (NIR - R) / (NIR + R)
+            ndvi_band = ndvi_band[np.newaxis, :, :]
+            image = np.concatenate([image, ndvi_band], axis=0).astype('float32')
+
+        elif datasource.lower() == 'sentinel':
+            ndvi_band = normalized_difference(image[3, :, :], image[2, :, :])  # (NIR - R) / (NIR + R)
+            ndvi_band = ndvi_band[np.newaxis, :, :]
+            image = np.concatenate([image, ndvi_band], axis=0).astype('float32')
+
+    if ndwi:
+        ndwi_band = normalized_difference(image[1, :, :], image[3, :, :])  # NDWI = (G-NIR)/(G+NIR)
+        ndwi_band = ndwi_band[np.newaxis, :, :]
+        image = np.concatenate([image, ndwi_band], axis=0).astype('float32')
+
+    return image
+
 
 class GenMARSH(Dataset):
+    """
+    Dataset of image patches, read either from a folder of GeoTIFF patches or from the single-file patch store
+    (patches.npy + patches.json + patch_index.csv) written by split_and_save_patches(store="npy").
+    """
 
-    def __init__(self, folder_path, mode="train", ndvi=True, ndwi=True, datasource="sentinel"):
+    def __init__(self, folder_path, mode="train", ndvi=True, ndwi=True, datasource="sentinel", min_valid_fraction=0.0,
+                 gate=None):
 
         self.folder_path = Path(folder_path)
-        self.image_files = sorted([
-            os.path.join(folder_path, f)
-            for f in os.listdir(folder_path)
-            if f.lower().endswith(".tif")
-        ])
+        self.store_path = self.folder_path / PATCH_STORE_ARRAY
+
+        # The sidecar index lists the window geotransform of every patch (written by split_and_save_patches)
+        self.index = None
+        index_path = self.folder_path / PATCH_INDEX
+        if index_path.is_file():
+            index = pd.read_csv(index_path)
+            if "transform" in index.columns:
+                self.index = index
+                self.rows = {name: i for i, name in enumerate(index["patch_name"])}
+
+        if self.store_path.is_file():
+            # The patch names come from the sidecar index, no directory listing needed
+            with open(self.folder_path / PATCH_STORE_META) as f:
+                self.store_meta = json.load(f)
+            self.image_files = self.index["patch_name"].tolist()
+        elif self.index is not None:
+            # GeoTIFF patches in the order of the index rows (the shard manifests are ranges of these rows),
+            # without listing a folder of possibly more than 10^5 files
+            self.store_meta = None
+            self.image_files = [str(self.folder_path / name) for name in self.index["patch_name"]]
+        else:
+            self.store_meta = None
+            self.image_files = sorted([
+                os.path.join(folder_path, f)
+                for f in os.listdir(folder_path)
+                if f.lower().endswith(".tif")
+            ])
+
+        # Profile shared by all the patches, only their size and geotransform differ
+        self._base_profile = None
+
+        # The memory-mapped store is opened on first access, so every DataLoader worker maps its own
+        self._store = None
 
         self.mode = mode
+        self.min_valid_fraction = min_valid_fraction
+        self.gate = gate
 
         self.ndvi = ndvi
         self.ndwi = ndwi
         self.datasource = datasource
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+    def skip_code(self, filename, image):
+        """
+        SKIP_NODATA for the empty patches flagged in the patch index, the code of the spectral gate for the
+        patches it marks (prepared image), RUN_MODEL otherwise.
+        """
+        if self.index is not None and "valid" in self.index.columns and filename in self.rows:
+            row = self.index.iloc[self.rows[filename]]
+            if not row["valid"] or row["valid_fraction"] < self.min_valid_fraction:
+                return SKIP_NODATA
+
+        if self.gate is not None:
+            return self.gate(image, self.datasource)
+        return RUN_MODEL
 
     def __len__(self):
         return len(self.image_files)
 
-    def __getitem__(self, idx):
+    def read_patch(self, idx):
+        """Reads the raw patch (CxHxW) and its file name."""
+        if self.store_meta is None:
+            img_path = self.image_files[idx]
+            with rasterio.open(img_path) as src:
+                return src.read(), os.path.basename(img_path)
 
-        img_path = self.image_files[idx]
+        if self._store is None:
+            self._store = np.load(self.store_path, mmap_mode="r")
+
+        row = self.index.iloc[idx]
+        image = np.array(self._store[idx, :, :row["height"], :row["width"]])
+        return image, row["patch_name"]
+
+    def get_profile(self, filename):
+        """
+        Returns the raster profile of a patch, used to write its prediction. The profile is built from the
+        patch index and a cached base profile, the patch file is only opened for folders without an index.
+        """
+        if self.index is None or filename not in self.rows:
+            with rasterio.open(self.folder_path / filename) as src:
+                return src.profile.copy()
+
+        if self._base_profile is None:
+            if self.store_meta is not None:
+                self._base_profile = {
+                    "driver": "GTiff",
+                    "dtype": self.store_meta["dtype"],
+                    "nodata": self.store_meta["nodata"],
+                    "count": self.store_meta["count"],
+                    "crs": CRS.from_wkt(self.store_meta["crs"]) if self.store_meta["crs"] else None
+                }
+            else:
+                with rasterio.open(self.image_files[0]) as src:
+                    self._base_profile = src.profile.copy()
+
+        row = self.index.iloc[self.rows[filename]]
+        profile = self._base_profile.copy()
+        profile.update({
+            "width": int(row["width"]),
+            "height": int(row["height"]),
+            "transform": Affine(*[float(v) for v in row["transform"].split(",")])
+        })
+        return profile
+
+    def __getitem__(self, idx):
 
         # the dimension is CxHxW
-        image = rasterio.open(img_path).read().astype('float32')
+        image, filename = self.read_patch(idx)
+        image = image.astype('float32')
 
         # target = self.df.iloc[idx].loc['label_path']
         # target = rasterio.open(target).read().astype('int8')  # 1xHxW
 
-        if self.datasource.lower() == 'naip':
-            image = image / 255.  # image = image/10000*3.5 (sentinel)
-        elif self.datasource.lower() == 'sentinel':
-            image = image / 10000
-        else:
-            raise ("The data source should be NAIP or sentinel")
-
-        if self.mode == "train":
-            # exclusing Coastal aerosol, Water vapour, and SWIR - Cirrus bands from analysis in Sentinel, since these bands are mainly for the atmospheric correction and cloud screen.
-            # 'RGBV' (B2, B3, B4, B8), 'B01'(Coastal aerosol), 'B05', 'B06', 'B07', 'B09'(Water vapour), 'B10' (SWIR - Cirrus), 'B11', 'B12', 'B8A' (in the original research data)
-            if self.datasource == 'sentinel':  # 5,9,10 (index: 4,8,9)
-                image = np.concatenate([image[:4, :, :], image[5:8, :, :], image[10:, :, :]], axis=0).astype('float32') #B2,3,4,8,5,6,7,11,12,B8A
-
-        elif self.mode == "test": # new processed data
-            if self.datasource == "sentinel":
-                # New sentinel data acquistion: band_list = ["02", "03", "04", "05", "06", "07", "08" ,"8A", "11", "12"]
-                # Change to B2,3,4,8,5,6,7,11,12,B8A
-                # make sure the testing data's band corresponds to the training data band
-                image = np.concatenate([
-                    image[:3],
-                    image[6][None, :, :],
-                    image[3:6],
-                    image[8:],
-                    image[7][None, :, :]
-                ], axis=0).astype('float32')
-
-        if self.ndvi:
-            if self.datasource.lower() == 'naip':  # NAIP bands: R,G,B,NIR
-                ndvi = (image[3, :, :] - image[0, :, :]) / (
-                            image[3, :, :] + image[0, :, :])  # (NIR - R) / (NIR + R)
-                ndvi = ndvi[np.newaxis, :, :]
-                image = np.concatenate([image, ndvi], axis=0).astype('float32')
-
-            elif self.datasource.lower() == 'sentinel':
-                ndvi = (image[3, :, :] - image[2, :, :]) / (
-                            image[3, :, :] + image[2, :, :])  # (NIR - R) / (NIR + R)
-                ndvi = ndvi[np.newaxis, :, :]
-                image = np.concatenate([image, ndvi], axis=0).astype('float32')
-
-        if self.ndwi:
-            ndwi = (image[1, :, :] - image[3, :, :]) / (image[1, :, :] + image[3, :, :])  # NDWI = (G-NIR)/(G+NIR)
-            ndwi = ndwi[np.newaxis, :, :]
-            image = np.concatenate([image, ndwi], axis=0).astype('float32')
+        image = prepare_image(image, self.mode, self.ndvi, self.ndwi, self.datasource)
 
         #         image = image[[0,1,2,3], :, :] # Use only four bands from Sentinel for testing.
-        sample = {'image': image, 'filename': os.path.basename(img_path)}
+        sample = {'image': image, 'filename': filename, 'skip': self.skip_code(filename, image)}
+
+        return sample
+
+
+def compute_windows(width, height, patch_size=128, overlap=0, skip_partial=True):
+    """
+    Generate the sliding windows over a raster, following the same grid as split_and_save_patches.
+
+    :param width: raster width in pixels
+    :param height: raster height in pixels
+    :param patch_size: window size in pixels (square)
+    :param overlap: overlap between windows in pixels
+    :param skip_partial: skip the windows that would go beyond the raster bounds, otherwise the last
+        row/column of windows is shifted back inside the raster so every pixel is covered
+    :return: list of rasterio Windows
+    """
+    step = patch_size - overlap
+
+    def offsets(size):
+        steps = list(range(0, max(size - patch_size, 0) + 1, step))
+        if not skip_partial and steps[-1] + patch_size < size:
+            steps.append(size - patch_size)
+        return steps
+
+    windows = []
+    for top in offsets(height):
+        for left in offsets(width):
+            win_width = min(patch_size, width - left)
+            win_height = min(patch_size, height - top)
+
+            if skip_partial and (win_width < patch_size or win_height < patch_size):
+                continue
+            windows.append(Window(left, top, win_width, win_height))
+
+    return windows
+
+
+class GenMARSHWindows(Dataset):
+    """
+    Inference dataset reading the windows lazily from a single raster (e.g. combined_<aoi>_<year>.tif or a raw
+    NAIP tile) instead of from a folder of image patches.
+
+    With a halo, every window is read with halo extra pixels on each side (reflect-padded beyond the raster
+    bounds and up to patch_size + 2 * halo), so the prediction of the window itself is cropped away from the
+    edges of the model input.
+
+    The windows without valid pixels, or with a fraction of valid pixels below min_valid_fraction, are flagged
+    SKIP_NODATA and not sent to the model, as well as the windows marked by the spectral gate.
+    """
+
+    def __init__(self, raster_path, patch_size=128, overlap=0, mode="test", ndvi=True, ndwi=True,
+                 datasource="sentinel", skip_partial=False, halo=0, min_valid_fraction=0.0, gate=None):
+
+        self.raster_path = Path(raster_path)
+        self.mode = mode
+        self.patch_size = patch_size
+        self.halo = halo
+        self.min_valid_fraction = min_valid_fraction
+        self.gate = gate
+
+        self.ndvi = ndvi
+        self.ndwi = ndwi
+        self.datasource = datasource
+
+        with rasterio.open(self.raster_path) as src:
+            self.profile = src.profile.copy()
+            self.windows = compute_windows(src.width, src.height, patch_size, overlap, skip_partial)
+            self.input_channels = prepare_image(np.ones((src.count, 1, 1)), mode, ndvi, ndwi, datasource).shape[0]
+
+        # Skip codes decided before reading the windows (see preset_codes)
+        self.window_codes = None
+
+        # The raster handle is opened on first access, so every DataLoader worker gets its own
+        self._src = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_src'] = None
+        return state
+
+    def __len__(self):
+        return len(self.windows)
+
+    def preset_codes(self, codes):
+        """
+        Sets the skip code of every window in advance, e.g. from a coarser prediction. The windows with a code
+        other than RUN_MODEL are not even read.
+        """
+        self.window_codes = list(codes)
+
+    def skip_code(self, raw, image):
+        """
+        SKIP_NODATA for the windows (raw band values) without enough valid pixels, the code of the spectral gate
+        for the windows it marks (prepared image), RUN_MODEL otherwise.
+        """
+        fraction = valid_fraction(raw, self._src.nodata)
+        if fraction <= 0 or fraction < self.min_valid_fraction:
+            return SKIP_NODATA
+
+        if self.gate is not None:
+            return self.gate(image, self.datasource)
+        return RUN_MODEL
+
+    def __getitem__(self, idx):
+
+        if self._src is None:
+            self._src = rasterio.open(self.raster_path)
+
+        window = self.windows[idx]
+
+        if self.window_codes is not None and self.window_codes[idx] != RUN_MODEL:
+            size = (self.patch_size + 2 * self.halo,) * 2 if self.halo else (window.height, window.width)
+            return {'image': np.zeros((self.input_channels,) + size, dtype='float32'),
+                    'window': np.array([window.col_off, window.row_off, window.width, window.height], dtype='int64'),
+                    'skip': self.window_codes[idx]}
+
+        if self.halo:
+            return self.read_with_halo(window)
+
+        # the dimension is CxHxW
+        raw = self._src.read(window=window)
+        image = prepare_image(raw, self.mode, self.ndvi, self.ndwi, self.datasource)
+
+        sample = {'image': image,
+                  'window': np.array([window.col_off, window.row_off, window.width, window.height], dtype='int64'),
+                  'skip': self.skip_code(raw, image)}
 
         return sample
 
+    def read_with_halo(self, window):
+        """Reads a window with its halo, the window itself starts at (halo, halo) of the returned image."""
+        halo = self.halo
+        size = self.patch_size + 2 * halo
+
+        # Part of the haloed window inside the raster
+        left = max(window.col_off - halo, 0)
+        top = max(window.row_off - halo, 0)
+        right = min(window.col_off + window.width + halo, self._src.width)
+        bottom = min(window.row_off + window.height + halo, self._src.height)
+
+        raw = self._src.read(window=Window(left, top, right - left, bottom - top))
+        image = prepare_image(raw, self.mode, self.ndvi, self.ndwi, self.datasource)
+
+        # Mirror the image beyond the raster bounds, and pad the windows smaller than patch_size to a fixed shape
+        pad_top = halo - (window.row_off - top)
+        pad_left = halo - (window.col_off - left)
+        pad_bottom = size - pad_top - image.shape[1]
+        pad_right = size - pad_left - image.shape[2]
+        image = np.pad(image, ((0, 0), (pad_top, pad_bottom), (pad_left, pad_right)), mode="reflect")
+
+        # Only the window itself, not its halo, decides whether it is empty or gated
+        core = raw[:, window.row_off - top:window.row_off - top + window.height,
+                   window.col_off - left:window.col_off - left + window.width]
+        core_image = image[:, halo:halo + window.height, halo:halo + window.width]
+
+        sample = {'image': image,
+                  'window': np.array([window.col_off, window.row_off, window.width, window.height], dtype='int64'),
+                  'skip': self.skip_code(core, core_image)}
+
+        return sample
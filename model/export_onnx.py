@@ -0,0 +1,101 @@
+from pathlib import Path
+import time
+
+import numpy as np
+import torch
+
+from trainer import SemanticSegmentationTask
+from inference import OnnxModel
+
+
+def load_task(checkpoint_path: Path) -> SemanticSegmentationTask:
+    """Loads the Lightning task from checkpoint on CPU, in evaluation mode."""
+    task = SemanticSegmentationTask.load_from_checkpoint(str(checkpoint_path), map_location="cpu")
+    task.eval()
+    return task
+
+
+def export_onnx(checkpoint_path: Path, output_path: Path, patch_size: int = 128, opset: int = 17) -> Path:
+    """
+    Exports the segmentation network of a checkpoint to an ONNX graph.
+
+    The number of input channels is read from the checkpoint hyperparameters, so the NDVI/NDWI features the
+    model was trained with are included. The batch and spatial axes are dynamic.
+    """
+    task = load_task(checkpoint_path)
+    in_channels = task.hyperparams["in_channels"]
+    dummy = torch.randn(1, in_channels, patch_size, patch_size)
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    print(f"[INFO] Exporting {checkpoint_path} ({in_channels} input channels) to: {output_path}")
+    torch.onnx.export(
+        task.model,
+        dummy,
+        str(output_path),
+        input_names=["image"],
+        output_names=["logits"],
+        dynamic_axes={
+            "image": {0: "batch", 2: "height", 3: "width"},
+            "logits": {0: "batch", 2: "height", 3: "width"}
+        },
+        opset_version=opset
+    )
+    return output_path
+
+
+def check_parity(checkpoint_path: Path, onnx_path: Path, patch_size: int = 128, batch_size: int = 32,
+                 repeats: int = 5, intra_op_threads: int = 0, inter_op_threads: int = 0, atol: float = 1e-3) -> bool:
+    """
+    Compares the ONNX Runtime output with the PyTorch output on random inputs and reports the CPU throughput
+    of both backends.
+    """
+    task = load_task(checkpoint_path)
+    onnx_model = OnnxModel(onnx_path, intra_op_threads, inter_op_threads)
+
+    X = torch.rand(batch_size, task.hyperparams["in_channels"], patch_size, patch_size)
+
+    throughput = {}
+    outputs = {}
+    with torch.no_grad():
+        for name, model in (("pytorch", task), ("onnxruntime", onnx_model)):
+            outputs[name] = model(X)  # warm-up
+            start = time.perf_counter()
+            for _ in range(repeats):
+                model(X)
+            throughput[name] = repeats * batch_size / (time.perf_counter() - start)
+
+    torch_out = outputs["pytorch"].numpy()
+    onnx_out = outputs["onnxruntime"].numpy()
+    max_diff = float(np.abs(torch_out - onnx_out).max())
+    agreement = float((torch_out.argmax(axis=1) == onnx_out.argmax(axis=1)).mean())
+
+    print(f"[INFO] Max absolute logit difference: {max_diff:.2e} (tolerance {atol:.0e})")
+    print(f"[INFO] Predicted class agreement: {agreement * 100:.3f}%")
+    for name, rate in throughput.items():
+        print(f"[INFO] {name:<12} {rate:8.1f} patches/s")
+
+    return max_diff <= atol
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a marsh segmentation checkpoint to ONNX.")
+    parser.add_argument("checkpoint", type=str, help="Path to the checkpoint, e.g. weights/sentinel/unet/last.ckpt")
+    parser.add_argument("--output", type=str, default=None, help="Output ONNX path, defaults to the checkpoint path with .onnx")
+    parser.add_argument("--patch-size", type=int, default=128, help="Patch size used for the export and the parity check (128 Sentinel, 256 NAIP)")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    parser.add_argument("--check", action="store_true", help="Check the ONNX Runtime output against PyTorch")
+    parser.add_argument("--intra-op-threads", type=int, default=0, help="ONNX Runtime intra-op threads (0 = default)")
+    parser.add_argument("--inter-op-threads", type=int, default=0, help="ONNX Runtime inter-op threads (0 = default)")
+
+    args = parser.parse_args()
+    output = Path(args.output) if args.output else Path(args.checkpoint).with_suffix(".onnx")
+
+    export_onnx(Path(args.checkpoint), output, args.patch_size, args.opset)
+
+    if args.check and not check_parity(Path(args.checkpoint), output, args.patch_size,
+                                       intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads):
+        raise SystemExit("[ERROR] ONNX Runtime output does not match the PyTorch output.")
@@ -0,0 +1,438 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+import rasterio
+from rasterio.windows import Window
+from torch.utils.data import DataLoader
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from processing.stitching import PredictionAccumulator
+from dataloader import RUN_MODEL, SKIP_NODATA, SKIP_NAMES, SpectralGate
+from trainer import SemanticSegmentationTask
+from quantization import build_int8_model
+from prediction_cache import PredictionCache, CachedModel, model_cache_key
+
+
+class OnnxModel:
+    """
+    ONNX Runtime CPU backend, called like the PyTorch model: takes and returns torch tensors (logits).
+
+    :param onnx_path: ONNX graph exported by export_onnx.py
+    :param intra_op_threads: threads used within an operator (0 lets ONNX Runtime decide)
+    :param inter_op_threads: threads running independent operators in parallel (0 lets ONNX Runtime decide)
+    """
+
+    def __init__(self, onnx_path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx backend requires onnxruntime, install it with `pip install onnxruntime`.")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        print(f"[INFO] Loading ONNX model from: {onnx_path}")
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        logits = self.session.run(None, {self.input_name: X.detach().cpu().numpy()})[0]
+        return torch.from_numpy(logits)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def bf16_supported(device: torch.device) -> bool:
+    """Whether the device has native bfloat16 kernels (AVX512-BF16/AMX on CPU)."""
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class FastModel:
+    """
+    Fast in-process PyTorch path: the network is compiled and run on channels-last tensors, optionally under
+    bfloat16 autocast. The patch sizes are fixed (128 Sentinel, 256 NAIP), so the compiled graph only has to be
+    specialised once per input shape; that warm-up call is timed separately from the inference. Smaller batches
+    (the last batch, or batches with skipped windows) are zero-padded to a warmed-up batch size instead of
+    triggering another compilation.
+
+    :param model: SemanticSegmentationTask (or plain network) in evaluation mode
+    :param device: torch device
+    :param bf16: run under bfloat16 autocast, ignored if the device has no native bfloat16 support
+    """
+
+    def __init__(self, model: torch.nn.Module, device: torch.device, bf16: bool = False):
+        self.device = device
+        self.model = model.to(device, memory_format=torch.channels_last).eval()
+
+        # Compile the network itself, the Lightning task forward only wraps it
+        network = getattr(self.model, "model", self.model)
+        self.compiled = torch.compile(network)
+
+        self.bf16 = bf16 and bf16_supported(device)
+        if bf16 and not self.bf16:
+            print(f"[WARN] No native bfloat16 support on {device.type}, running in float32.")
+
+        self.warmed_up = set()
+        self.warmup_seconds = 0.0
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            return self.compiled(X).float()
+
+    def warm_up(self, X: torch.Tensor) -> None:
+        start = time.perf_counter()
+        try:
+            self.forward(X)
+        except Exception as e:
+            # e.g. no C++ compiler available for the inductor backend
+            warnings.warn(f"torch.compile failed ({e}), running the channels-last model eagerly.")
+            self.compiled = getattr(self.model, "model", self.model)
+            self.forward(X)
+        seconds = time.perf_counter() - start
+        self.warmup_seconds += seconds
+        self.warmed_up.add(tuple(X.shape))
+        print(f"[INFO] Warmed up for input shape {tuple(X.shape)} in {seconds:.1f}s")
+
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        X = X.contiguous(memory_format=torch.channels_last)
+
+        # Smaller batches (last batch, skipped windows) are padded to a warmed-up batch size instead of compiled
+        batch = len(X)
+        sizes = [shape[0] for shape in self.warmed_up if shape[1:] == tuple(X.shape[1:]) and shape[0] > batch]
+        if sizes:
+            padding = X.new_zeros((min(sizes) - batch,) + tuple(X.shape[1:]))
+            X = torch.cat([X, padding]).contiguous(memory_format=torch.channels_last)
+
+        if tuple(X.shape) not in self.warmed_up:
+            self.warm_up(X)
+        return self.forward(X)[:batch]
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def parse_shard(value: str):
+    """Parses the --shard option "i/N" (shard i, counted from 0, of N shards)."""
+    shard, num_shards = (int(v) for v in value.split("/"))
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard {shard} is not in 0..{num_shards - 1}.")
+    return shard, num_shards
+
+
+def add_inference_arguments(parser) -> None:
+    """Adds the command line options shared by the marsh inference scripts."""
+    parser.add_argument("--num-workers", type=int, default=4, help="Number of DataLoader processes prefetching the batches")
+    parser.add_argument("--writer-workers", type=int, default=2, help="Number of threads writing the predictions")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch",
+                        help="'torch' runs the checkpoint, 'onnx' runs the exported last.onnx under ONNX Runtime on CPU")
+    parser.add_argument("--precision", choices=["fp32", "int8"], default="fp32",
+                        help="'int8' quantizes the network for CPU inference, calibrated on a sample of the patches")
+    parser.add_argument("--calibration-samples", type=int, default=256, help="Number of patches calibrating the INT8 model")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of inference processes, each running its own model copy on a shard of the patches")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="i/N: only infer shard i (from 0) of N of the manifest, e.g. one shard per machine")
+    parser.add_argument("--merge", action="store_true",
+                        help="Combine the finished shards into the final mosaic, listing the shards still to run")
+    parser.add_argument("--fast", action="store_true",
+                        help="Compile the PyTorch model and run it on channels-last tensors (torch backend, fp32)")
+    parser.add_argument("--bf16", action="store_true", help="With --fast, run under bfloat16 autocast where supported")
+    parser.add_argument("--min-valid-fraction", type=float, default=0.01,
+                        help="Windows with a lower fraction of valid (non-nodata) pixels are skipped and written as nodata")
+    parser.add_argument("--gate", action="store_true",
+                        help="Skip the model on windows that are certain water or non-marsh from their NDWI/NDVI")
+    parser.add_argument("--gate-water-ndwi", type=float, default=0.5, help="NDWI from which a pixel is water")
+    parser.add_argument("--gate-water-fraction", type=float, default=0.95,
+                        help="Windows with at least this fraction of water pixels are gated as water")
+    parser.add_argument("--gate-vegetation-ndvi", type=float, default=0.2, help="NDVI from which a pixel is vegetated")
+    parser.add_argument("--gate-vegetation-fraction", type=float, default=0.01,
+                        help="Windows with a lower fraction of vegetated pixels are gated as non-marsh")
+    parser.add_argument("--memory-budget", type=int, default=4096,
+                        help="Memory budget (MB) sizing the windows of the 'large' mode")
+    parser.add_argument("--halo", type=int, default=32,
+                        help="Context (px) read around every window of the 'large' mode and cropped from its prediction")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Serve the unchanged input windows from a prediction cache in this folder")
+    parser.add_argument("--cache-size-gb", type=float, default=10, help="Maximum size of the prediction cache")
+    parser.add_argument("--intra-op-threads", type=int, default=0, help="ONNX Runtime intra-op threads (0 = default)")
+    parser.add_argument("--inter-op-threads", type=int, default=0, help="ONNX Runtime inter-op threads (0 = default)")
+
+
+def make_gate(gate: bool = False, gate_water_ndwi: float = 0.5, gate_water_fraction: float = 0.95,
+              gate_vegetation_ndvi: float = 0.2, gate_vegetation_fraction: float = 0.01):
+    """SpectralGate from the command line options, None when gating is off."""
+    if not gate:
+        return None
+    return SpectralGate(gate_water_ndwi, gate_water_fraction, gate_vegetation_ndvi, gate_vegetation_fraction)
+
+
+def load_inference_model(checkpoint_path: Path, dataset, backend: str = "torch", precision: str = "fp32",
+                         intra_op_threads: int = 0, inter_op_threads: int = 0, calibration_samples: int = 256,
+                         batch_size: int = 32, fast: bool = False, bf16: bool = False, cache_dir: Path = None, cache_size_gb: float = 10):
+    """
+    Loads the model for the selected backend and precision.
+
+    :param checkpoint_path: Lightning checkpoint, the onnx backend loads the .onnx file next to it
+    :param dataset: dataset to infer, the INT8 model is calibrated on a sample of it
+    :param batch_size: inference batch size, also used to calibrate the INT8 model
+    :param fast: compiled, channels-last PyTorch model (see FastModel)
+    :param bf16: bfloat16 autocast for the fast model
+    :param cache_dir: serve the unchanged input windows from a prediction cache in this folder
+    :param cache_size_gb: maximum size of the prediction cache
+    :return: model in evaluation mode and the device to run it on
+    """
+    if backend == "onnx":
+        model_path = Path(checkpoint_path).with_suffix(".onnx")
+        model = OnnxModel(model_path, intra_op_threads, inter_op_threads)
+        device = torch.device("cpu")
+    else:
+        model_path = checkpoint_path
+        print(f"[INFO] Loading model from: {checkpoint_path}")
+        model = SemanticSegmentationTask.load_from_checkpoint(str(checkpoint_path), map_location="cpu")
+        model.eval()
+
+        if precision == "int8":
+            # Quantized kernels only run on CPU
+            device = torch.device("cpu")
+            model = build_int8_model(model, dataset, calibration_samples, batch_size)
+        else:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            if fast:
+                model = FastModel(model, device, bf16)
+            else:
+                model.to(device)
+
+    if cache_dir is not None:
+        # bf16 changes the outputs, the compilation and threads do not
+        key = model_cache_key(model_path, dataset, backend=backend, precision=precision, bf16=fast and bf16)
+        model = CachedModel(model, PredictionCache(cache_dir, key, int(cache_size_gb * 2 ** 30)))
+
+    return model, device
+
+
+def make_dataloader(dataset, batch_size: int = 32, num_workers: int = 4) -> DataLoader:
+    """DataLoader prefetching the batches in num_workers background processes."""
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        prefetch_factor=2 if num_workers > 0 else None,
+        persistent_workers=False
+    )
+
+
+class PatchWriter:
+    """Writes the prediction of every patch to its own GeoTIFF (pred_<patch name>)."""
+
+    def __init__(self, dataset, output_dir: Path):
+        self.dataset = dataset
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, probs, batch) -> None:
+        preds = probs.argmax(axis=1).astype("float32")
+        skip = batch['skip'].tolist() if 'skip' in batch else [RUN_MODEL] * len(preds)
+        for pred, fname, code in zip(preds, batch['filename'], skip):
+            # The profile comes from the patch index, the source patch is not reopened
+            profile = self.dataset.get_profile(fname)
+            profile.update({
+                "count": 1,
+                "dtype": "float32",
+                "nodata": 255,
+                "compress": "lzw"
+            })
+            if code == SKIP_NODATA:
+                pred[:] = 255
+            with rasterio.open(self.output_dir / f"pred_{fname}", 'w', **profile) as dst:
+                dst.write(pred, 1)
+
+
+class AccumulatorWriter:
+    """
+    Adds the class probabilities of every window to a PredictionAccumulator, after cropping the halo read
+    around the window by GenMARSHWindows.
+
+    The constant predictions of the gated windows get a small weight: they cover the pixels no model prediction
+    reaches, without diluting the model predictions of the overlapping windows.
+    """
+
+    GATED_WEIGHT = 1e-3
+
+    def __init__(self, accumulator: PredictionAccumulator, halo: int = 0):
+        self.accumulator = accumulator
+        self.halo = halo
+
+    def __call__(self, probs, batch) -> None:
+        h = self.halo
+        skip = batch['skip'].tolist() if 'skip' in batch else [RUN_MODEL] * len(probs)
+        for prob, (col_off, row_off, width, height), code in zip(probs, batch['window'].tolist(), skip):
+            if code == SKIP_NODATA:
+                # Left without weight, so it is written as nodata
+                continue
+            weight = 1.0 if code == RUN_MODEL else self.GATED_WEIGHT
+            self.accumulator.add(prob[:, h:h + height, h:h + width], Window(col_off, row_off, width, height), weight)
+
+
+# Output stride of the segmentation_models_pytorch encoders: the model input size must be a multiple of it
+ENCODER_STRIDE = 32
+
+# Rough float32 activation footprint of the U-Net per input pixel, used to size the large windows
+ACTIVATION_BYTES_PER_PIXEL = 2048
+
+
+def large_window_size(memory_budget_mb: int = 4096, halo: int = 32, batch_size: int = 1,
+                      min_size: int = 256, max_size: int = 2048, stride: int = ENCODER_STRIDE):
+    """
+    Picks the size of the large inference windows fitting a memory budget.
+
+    :param memory_budget_mb: memory available for the activations of one batch
+    :param halo: context read on each side of a window, rounded up to the stride
+    :return: (window size, halo), both multiples of the stride so the model input is too
+    """
+    halo = -(-halo // stride) * stride
+    input_size = int((memory_budget_mb * 2 ** 20 / (batch_size * ACTIVATION_BYTES_PER_PIXEL)) ** 0.5)
+    size = (input_size - 2 * halo) // stride * stride
+    return min(max(size, min_size), max_size), halo
+
+
+def run_pipelined_inference(model: torch.nn.Module, dataloader, writer, device: torch.device,
+                            writer_workers: int = 2, max_pending: int = 4, progress=None, num_classes: int = 2) -> dict:
+    """
+    Runs inference as a read -> infer -> write pipeline.
+
+    The batches are prefetched by the DataLoader workers, the model runs on the main thread and the predictions
+    are handed over to a bounded pool of background writer threads, so reading, computing and writing overlap.
+    The samples flagged by the dataset ('skip' other than RUN_MODEL) do not reach the model: the windows gated
+    as water or non-marsh get a constant non-marsh probability of 1, the empty windows are left at 0 and written
+    as nodata by the writers.
+
+    :param model: model in evaluation mode, on the device
+    :param dataloader: DataLoader over GenMARSH or GenMARSHWindows
+    :param writer: callable(probs, batch) writing the class probabilities (BxCxHxW numpy array) of a batch
+    :param device: torch device
+    :param writer_workers: number of writer threads
+    :param max_pending: maximum number of batches waiting to be written
+    :param progress: callable(number of samples) called after every batch, replaces the per-batch message
+    :param num_classes: number of classes predicted by the model
+    :return: per-stage seconds, number of samples and number of skipped samples per reason
+    """
+    stats = {"read": 0.0, "compute": 0.0, "write": 0.0, "samples": 0,
+             "skipped": {name: 0 for name in SKIP_NAMES.values()}}
+
+    def timed_write(probs, batch):
+        start = time.perf_counter()
+        writer(probs, batch)
+        return time.perf_counter() - start
+
+    pending = deque()
+    run_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=writer_workers) as executor, torch.no_grad():
+        start = time.perf_counter()
+        for i, batch in enumerate(dataloader):
+            read_end = time.perf_counter()
+            stats["read"] += read_end - start
+
+            if progress is None:
+                print(f"[INFO] Processing batch {i + 1}/{len(dataloader)}")
+            X = batch['image']
+            if 'skip' in batch:
+                run = batch['skip'] == RUN_MODEL
+                probs = np.zeros((len(X), num_classes) + tuple(X.shape[2:]), dtype="float32")
+                if run.any():
+                    probs[run.numpy()] = torch.softmax(model(X[run].to(device)), dim=1).float().cpu().numpy()
+                for code, name in SKIP_NAMES.items():
+                    skipped = (batch['skip'] == code).numpy()
+                    stats["skipped"][name] += int(skipped.sum())
+                    if code != SKIP_NODATA:
+                        probs[skipped, 0] = 1.0
+            else:
+                probs = torch.softmax(model(X.to(device)), dim=1).float().cpu().numpy()
+            stats["compute"] += time.perf_counter() - read_end
+            stats["samples"] += len(probs)
+            if progress is not None:
+                progress(len(probs))
+
+            pending.append(executor.submit(timed_write, probs, batch))
+            while len(pending) > max_pending:
+                stats["write"] += pending.popleft().result()
+
+            start = time.perf_counter()
+
+        while pending:
+            stats["write"] += pending.popleft().result()
+
+    stats["total"] = time.perf_counter() - run_start
+    # The one-off compilation of the fast model is not part of the steady-state compute throughput
+    stats["warmup"] = getattr(model, "warmup_seconds", 0.0)
+    stats["compute"] -= stats["warmup"]
+    report_throughput(stats)
+    if hasattr(model, "cache"):
+        model.cache.report()
+    return stats
+
+
+def report_throughput(stats: dict) -> None:
+    """Prints the per-stage throughput of a pipelined inference run."""
+    samples = stats["samples"]
+    print(f"[INFO] {samples} patches in {stats['total']:.1f}s ({samples / max(stats['total'], 1e-9):.1f} patches/s)")
+    if stats.get("warmup"):
+        print(f"[INFO]   {'warm-up':<8} {stats['warmup']:8.1f}s")
+    skipped = sum(stats.get("skipped", {}).values())
+    if skipped:
+        reasons = ", ".join(f"{count} {name}" for name, count in stats["skipped"].items() if count)
+        print(f"[INFO]   {skipped} of {samples} patches skipped without running the model ({reasons})")
+        modeled = samples - skipped
+        if modeled:
+            print(f"[INFO]   ~{skipped * stats['compute'] / modeled:.1f}s of compute saved "
+                  f"({skipped / samples * 100:.1f}% of the patches)")
+    for stage in ("read", "compute", "write"):
+        seconds = stats[stage]
+        rate = samples / seconds if seconds > 0 else float("inf")
+        print(f"[INFO]   {stage:<8} {seconds:8.1f}s  {rate:10.1f} patches/s")
+
+
+def run_window_inference(model: torch.nn.Module, dataloader, output_path: Path, device: torch.device,
+                         num_classes: int = 2, writer_workers: int = 2, output: str = "class") -> None:
+    """
+    Runs inference on the windows of a GenMARSHWindows dataset and accumulates the class probabilities over the
+    grid of the source raster, so the overlapping windows are averaged before the single output raster is written.
+
+    :param output: "class" writes the predicted class, "probability" the marsh probability (see PredictionAccumulator.flush)
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    print("[INFO] Starting windowed inference...")
+    halo = getattr(dataloader.dataset, "halo", 0)
+    with PredictionAccumulator(dataloader.dataset.profile, num_classes, work_dir=output_path.parent) as accumulator:
+        run_pipelined_inference(model, dataloader, AccumulatorWriter(accumulator, halo), device, writer_workers)
+        accumulator.flush(output_path, output)
+
+    print(f"[INFO] Predictions written to: {output_path}")
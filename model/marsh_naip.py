@@ -2,9 +2,10 @@
 from pathlib import Path
 import torch
 from torch.utils.data import DataLoader
-import rasterio
-from dataloader import GenMARSH
-from trainer import SemanticSegmentationTask
+from dataloader import GenMARSH, GenMARSHWindows
+from inference import run_window_inference, run_pipelined_inference, make_dataloader, PatchWriter, \
+    load_inference_model, add_inference_arguments, large_window_size, make_gate
+from sharding import run_sharded_inference, infer_shard, merge_shards
 import sys
 
 project_root = Path(__file__).resolve().parent.parent
@@ -14,64 +15,22 @@ from processing.stitching import stitch_tiff_patches
 
 import os
 
-def load_model(checkpoint_path: Path, device: torch.device) -> torch.nn.Module:
-    """Loads the model from checkpoint and sets it to evaluation mode."""
-    print(f"[INFO] Loading model from: {checkpoint_path}")
-    model = SemanticSegmentationTask.load_from_checkpoint(str(checkpoint_path))
-    model.to(device)
-    model.eval()
-    return model
-
-
-def prepare_dataloader(patch_folder: Path, batch_size: int = 32) -> DataLoader:
-    """Prepares the dataloader for inference."""
-    dataset = GenMARSH(str(patch_folder), ndwi=False, datasource="NAIP")
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=0,
-        pin_memory=False
-    )
-    return dataloader
-
-
-def write_prediction(pred: torch.Tensor, filename: str, reference_path: Path, output_dir: Path) -> None:
-    """Writes a single prediction array to a GeoTIFF using the reference image's metadata."""
-    with rasterio.open(reference_path) as src:
-        profile = src.profile
-        profile.update({
-            "count": 1,
-            "dtype": 'float32',
-            "compress": "lzw"
-        })
-        out_path = output_dir / f"pred_{filename}"
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            dst.write(pred.astype('float32'), 1)
-
-
-def run_inference(model: torch.nn.Module, dataloader: DataLoader, output_dir: Path, device: torch.device) -> None:
-    """Runs inference on all batches and saves the predictions."""
-    output_dir.mkdir(parents=True, exist_ok=True)
-
+def run_inference(model: torch.nn.Module, dataloader: DataLoader, output_dir: Path, device: torch.device,
+                  writer_workers: int = 2) -> None:
+    """Runs inference on all batches and saves the predictions, writing them in background threads."""
     print("[INFO] Starting inference...")
-    with torch.no_grad():
-        for i, batch in enumerate(dataloader):
-            print(f"[INFO] Processing batch {i+1}/{len(dataloader)}")
-
-            X = batch['image'].to(device)
-            filenames = batch['filename']
-            output = model(X)
-            preds = torch.argmax(output, dim=1).cpu().numpy()
-
-            for pred, fname in zip(preds, filenames):
-                original_path = dataloader.dataset.folder_path / fname
-                write_prediction(pred, fname, original_path, output_dir)
-
+    run_pipelined_inference(model, dataloader, PatchWriter(dataloader.dataset, output_dir), device, writer_workers)
     print("[INFO] Inference complete.")
 
 
-def main(year: str, tile_name: str) -> None:
+def main(year: str, tile_name: str, mode: str = "patches", num_workers: int = 4, writer_workers: int = 2,
+         backend: str = "torch", precision: str = "fp32", calibration_samples: int = 256,
+         intra_op_threads: int = 0, inter_op_threads: int = 0, fast: bool = False, bf16: bool = False,
+         memory_budget: int = 4096, halo: int = 32, processes: int = 1,
+         shard: tuple = None, merge: bool = False, cache_dir: str = None, cache_size_gb: float = 10,
+         min_valid_fraction: float = 0.01, gate: bool = False, gate_water_ndwi: float = 0.5,
+         gate_water_fraction: float = 0.95, gate_vegetation_ndvi: float = 0.2,
+         gate_vegetation_fraction: float = 0.01) -> None:
 
     base_path = os.path.join(project_root, 'dataset')
 
@@ -83,12 +42,58 @@ def main(year: str, tile_name: str) -> None:
     prediction_output = Path(base_path) / f"predicted/NAIP/inference_{year}_{suffix}"
     mosaic_output = Path(base_path) / f"predicted/NAIP/merge_{year}_{suffix}.tif"
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     batch_size = 32
 
-    dataloader = prepare_dataloader(patch_folder, batch_size)
-    model = load_model(checkpoint_path, device)
-    run_inference(model, dataloader, prediction_output, device)
+    raw_tile_path = Path(base_path) / f"raw/NAIP/{year}/{tile_name}.tif"
+
+    # Windows that are certain water or non-marsh from their NDWI/NDVI skip the model (--gate)
+    spectral_gate = make_gate(gate, gate_water_ndwi, gate_water_fraction, gate_vegetation_ndvi, gate_vegetation_fraction)
+
+    if mode == "windows":
+        # Read the 256 x 256 windows straight from the raw NAIP tile and write a single prediction raster
+        dataset = GenMARSHWindows(raw_tile_path, patch_size=256, overlap=30, ndwi=False, datasource="NAIP",
+                                  min_valid_fraction=min_valid_fraction, gate=spectral_gate)
+    elif mode == "large":
+        # Run the fully convolutional model on large windows fitting the memory budget, cropping their halo
+        window_size, halo = large_window_size(memory_budget, halo)
+        print(f"[INFO] Large windows of {window_size} px with a {halo} px halo")
+        dataset = GenMARSHWindows(raw_tile_path, patch_size=window_size, ndwi=False, datasource="NAIP", halo=halo,
+                                  min_valid_fraction=min_valid_fraction, gate=spectral_gate)
+        batch_size = 1
+    else:
+        dataset = GenMARSH(str(patch_folder), ndwi=False, datasource="NAIP", min_valid_fraction=min_valid_fraction,
+                           gate=spectral_gate)
+
+    # The onnx backend loads the exported weights/NAIP/unet/last.onnx (python model/export_onnx.py --patch-size 256)
+    model_options = dict(backend=backend, precision=precision, intra_op_threads=intra_op_threads,
+                         inter_op_threads=inter_op_threads, calibration_samples=calibration_samples,
+                         fast=fast, bf16=bf16, cache_dir=cache_dir, cache_size_gb=cache_size_gb)
+
+    output = mosaic_output if mode in ("windows", "large") else prediction_output
+
+    if merge:
+        # Sum the window shards into the mosaic, or check that all the patch shards are done before stitching
+        merge_shards(dataset, output)
+        if mode in ("windows", "large"):
+            return
+    elif shard is not None:
+        # One shard of the manifest (e.g. on one of several machines), merged later with --merge
+        infer_shard(checkpoint_path, dataset, output, *shard, batch_size, model_options, num_workers, writer_workers)
+        return
+    elif processes > 1:
+        # One model copy per process, each inferring a shard of the patches or windows
+        run_sharded_inference(checkpoint_path, dataset, output, processes, batch_size, model_options, writer_workers)
+        if mode in ("windows", "large"):
+            return
+    else:
+        model, device = load_inference_model(checkpoint_path, dataset, batch_size=batch_size, **model_options)
+        dataloader = make_dataloader(dataset, batch_size, num_workers)
+
+        if mode in ("windows", "large"):
+            run_window_inference(model, dataloader, mosaic_output, device, writer_workers=writer_workers)
+            return
+
+        run_inference(model, dataloader, prediction_output, device, writer_workers)
 
     print("[INFO] Stitching predicted tiles into a mosaic...")
 
@@ -107,8 +112,11 @@ def main(year: str, tile_name: str) -> None:
         print("\n[Option 2] Using `gdal_merge.py` (may also hit file limits):")
         print(f"  gdal_merge.py -o {mosaic_output} {prediction_output}/*.tif")
 
-        print("\n[Option 3] Implement chunked stitching using rasterio in batches.")
-        print("  (e.g., group files and merge a few hundred at a time into intermediate mosaics)")
+        print("\n[Option 3] Chunked stitching with bounded open files (running it now):")
+        print(f"  python processing/stitching.py --chunked {prediction_output} {mosaic_output}")
+
+        stitch_tiff_patches(prediction_output, mosaic_output, chunked=True)
+        print(f"[INFO] Mosaic saved to: {mosaic_output}")
 
 
 if __name__ == "__main__":
@@ -117,15 +125,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run marsh segmentation inference and stitching.")
     parser.add_argument("--year", type=str, required=True, help="Year of NAIP imagery to process")
     parser.add_argument("--tile-name", type=str, default="", help="Optional tile name to append to output folder")
+    parser.add_argument("--mode", choices=["patches", "windows", "large"], default="patches",
+                        help="'patches' reads the patch folder, 'windows' streams windows from the raw NAIP tile, "
+                             "'large' runs the model on large haloed windows of the raw NAIP tile")
+    add_inference_arguments(parser)
 
     args = parser.parse_args()
-    main(args.year, args.tile_name)
-
-
-
-
-
-
-
-
-
+    main(**vars(args))
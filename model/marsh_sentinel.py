@@ -87,11 +87,11 @@ sys.path.append(str(project_root))
 from processing.stitching import stitch_tiff_patches
 
 import torch
-from torch.utils.data import DataLoader
-import rasterio
 
-from trainer import SemanticSegmentationTask
-from dataloader import GenMARSH
+from dataloader import GenMARSH, GenMARSHWindows
+from inference import run_window_inference, run_pipelined_inference, make_dataloader, PatchWriter, \
+    load_inference_model, add_inference_arguments, large_window_size, make_gate
+from sharding import run_sharded_inference, infer_shard, merge_shards
 
 
 
@@ -103,52 +103,82 @@ def get_paths(year: str, aoi: str) -> dict:
     root = get_project_root()
     return {
         "patches": root / "dataset" / "processed" / f"sentinel_{aoi}_{year}" / "patches",
+        "raster": root / "dataset" / "processed" / f"sentinel_{aoi}_{year}" / f"combined_{aoi}_{year}.tif",
         "weights": root / "weights" / "sentinel" / "unet" / "last.ckpt",
         "output": root / "dataset" / "predicted" / "sentinel" / f"inference_{aoi}_{year}",
         "mosaic": root / "dataset" / "predicted" / "sentinel" / f"merge_{aoi}_{year}.tif"
     }
 
 
-def run_inference(model, dataloader, output_dir: Path, device: torch.device) -> None:
+def run_inference(model, dataloader, output_dir: Path, device: torch.device, writer_workers: int = 2) -> None:
     model.eval()
     model.to(device)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     print("Starting inference...")
-    with torch.no_grad():
-        for i, batch in enumerate(dataloader):
-            print(f"Processing batch {i + 1}")
-            X = batch["image"].to(device)
-            filenames = batch["filename"]
-            preds = torch.argmax(model(X), dim=1).cpu().numpy()
-
-            for pred, fname in zip(preds, filenames):
-                input_path = dataloader.dataset.folder_path / fname
-                output_path = output_dir / f"pred_{fname}"
-
-                with rasterio.open(input_path) as src:
-                    profile = src.profile.copy()
-                    profile.update({
-                        "count": 1,
-                        "dtype": "float32",
-                        "compress": "lzw"
-                    })
-
-                    with rasterio.open(output_path, 'w', **profile) as dst:
-                        dst.write(pred.astype("float32"), 1)
-
-
-def main(year: str = "2017", aoi: str = 'aoi', batch_size: int = 32) -> None:
-    paths = get_paths(year, aoi)
-    paths["output"].mkdir(parents=True, exist_ok=True)
+    run_pipelined_inference(model, dataloader, PatchWriter(dataloader.dataset, output_dir), device, writer_workers)
 
-    dataset = GenMARSH(paths["patches"], mode="test")
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0, pin_memory=False)
 
-    model = SemanticSegmentationTask.load_from_checkpoint(paths["weights"])
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def main(year: str = "2017", aoi: str = 'aoi', batch_size: int = 32, mode: str = "patches",
+         num_workers: int = 4, writer_workers: int = 2, backend: str = "torch", precision: str = "fp32",
+         calibration_samples: int = 256, intra_op_threads: int = 0, inter_op_threads: int = 0,
+         fast: bool = False, bf16: bool = False, memory_budget: int = 4096, halo: int = 32, processes: int = 1,
+         shard: tuple = None, merge: bool = False, cache_dir: str = None, cache_size_gb: float = 10,
+         min_valid_fraction: float = 0.01, gate: bool = False, gate_water_ndwi: float = 0.5,
+         gate_water_fraction: float = 0.95, gate_vegetation_ndvi: float = 0.2,
+         gate_vegetation_fraction: float = 0.01) -> None:
+    paths = get_paths(year, aoi)
 
-    run_inference(model, dataloader, paths["output"], device)
+    # Windows that are certain water or non-marsh from their NDWI/NDVI skip the model (--gate)
+    spectral_gate = make_gate(gate, gate_water_ndwi, gate_water_fraction, gate_vegetation_ndvi, gate_vegetation_fraction)
+
+    if mode == "windows":
+        # Read the 128 x 128 windows straight from the combined raster and write a single prediction raster
+        dataset = GenMARSHWindows(paths["raster"], patch_size=128, overlap=10, mode="test",
+                                  min_valid_fraction=min_valid_fraction, gate=spectral_gate)
+    elif mode == "large":
+        # Run the fully convolutional model on large windows fitting the memory budget, cropping their halo
+        window_size, halo = large_window_size(memory_budget, halo)
+        print(f"[INFO] Large windows of {window_size} px with a {halo} px halo")
+        dataset = GenMARSHWindows(paths["raster"], patch_size=window_size, mode="test", halo=halo,
+                                  min_valid_fraction=min_valid_fraction, gate=spectral_gate)
+        batch_size = 1
+    else:
+        dataset = GenMARSH(paths["patches"], mode="test", min_valid_fraction=min_valid_fraction,
+                           gate=spectral_gate)
+
+    # The onnx backend loads the exported weights/sentinel/unet/last.onnx (python model/export_onnx.py)
+    model_options = dict(backend=backend, precision=precision, intra_op_threads=intra_op_threads,
+                         inter_op_threads=inter_op_threads, calibration_samples=calibration_samples,
+                         fast=fast, bf16=bf16, cache_dir=cache_dir, cache_size_gb=cache_size_gb)
+
+    output = paths["mosaic"] if mode in ("windows", "large") else paths["output"]
+
+    if merge:
+        # Sum the window shards into the mosaic, or check that all the patch shards are done before stitching
+        merge_shards(dataset, output)
+        if mode in ("windows", "large"):
+            return
+    elif shard is not None:
+        # One shard of the manifest (e.g. on one of several machines), merged later with --merge
+        infer_shard(paths["weights"], dataset, output, *shard, batch_size, model_options, num_workers, writer_workers)
+        return
+    elif processes > 1:
+        # One model copy per process, each inferring a shard of the patches or windows
+        run_sharded_inference(paths["weights"], dataset, output, processes, batch_size, model_options, writer_workers)
+        if mode in ("windows", "large"):
+            return
+    else:
+        model, device = load_inference_model(paths["weights"], dataset, batch_size=batch_size, **model_options)
+        dataloader = make_dataloader(dataset, batch_size, num_workers)
+
+        if mode in ("windows", "large"):
+            run_window_inference(model, dataloader, paths["mosaic"], device, writer_workers=writer_workers)
+            return
+
+        paths["output"].mkdir(parents=True, exist_ok=True)
+
+        run_inference(model, dataloader, paths["output"], device, writer_workers)
 
     # Stitch the predicted patches
     try:
@@ -166,12 +196,23 @@ def main(year: str = "2017", aoi: str = 'aoi', batch_size: int = 32) -> None:
         print("\n[Option 2] Using `gdal_merge.py` (may also hit file limits):")
         print(f"  gdal_merge.py -o {paths['mosaic']} {paths['output']}/*.tif")
 
-        print("\n[Option 3] Implement chunked stitching using rasterio in batches.")
-        print("  (e.g., group files and merge a few hundred at a time into intermediate mosaics)")
-
-if __name__ == "__main__":
-    main('2018', 'aoi')
-
-
+        print("\n[Option 3] Chunked stitching with bounded open files (running it now):")
+        print(f"  python processing/stitching.py --chunked {paths['output']} {paths['mosaic']}")
 
+        stitch_tiff_patches(paths["output"], paths["mosaic"], chunked=True)
+        print(f"[INFO] Mosaic saved to: {paths['mosaic']}")
 
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run marsh segmentation inference on Sentinel imagery.")
+    parser.add_argument("--year", type=str, default="2018", help="Year of Sentinel imagery to process")
+    parser.add_argument("--aoi", type=str, default="aoi", help="AOI name used in the preprocessing step")
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of patches per batch")
+    parser.add_argument("--mode", choices=["patches", "windows", "large"], default="patches",
+                        help="'patches' reads the patch folder, 'windows' streams windows from the combined raster, "
+                             "'large' runs the model on large haloed windows of the combined raster")
+    add_inference_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
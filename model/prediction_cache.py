@@ -0,0 +1,154 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+
+def file_digest(path: Path, chunk_size: int = 2 ** 20) -> str:
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_cache_key(model_path: Path, dataset, **options) -> str:
+    """
+    Identifies what turns an input window into a prediction: the model weights, the feature configuration of
+    the dataset (band scaling and order, NDVI/NDWI) and the inference options (backend, precision).
+    """
+    config = {
+        "weights": file_digest(model_path),
+        "mode": getattr(dataset, "mode", None),
+        "datasource": getattr(dataset, "datasource", None),
+        "ndvi": getattr(dataset, "ndvi", None),
+        "ndwi": getattr(dataset, "ndwi", None),
+        **options
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed on-disk cache of the model outputs.
+
+    An entry is keyed by the hash of the model input window and of the model key, so reruns after changing the
+    post-processing, overlapping AOIs or unchanged NAIP quads are served from disk. The least recently used
+    entries (by file modification time, refreshed on every hit) are evicted when the cache exceeds max_bytes.
+
+    :param cache_dir: cache folder, shared by runs and processes
+    :param model_key: hash of the model and feature configuration (see model_cache_key)
+    :param max_bytes: maximum size of the cache
+    """
+
+    def __init__(self, cache_dir: Path, model_key: str, max_bytes: int = 10 * 2 ** 30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_key = model_key.encode()
+        self.max_bytes = max_bytes
+
+        self.size = sum(f.stat().st_size for f in self.cache_dir.glob("*/*.npy"))
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def key(self, image: np.ndarray) -> str:
+        digest = hashlib.sha256(self.model_key)
+        digest.update(str(image.shape).encode())
+        digest.update(np.ascontiguousarray(image).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
+
+    def get(self, key: str):
+        """Returns the cached output, or None."""
+        path = self.path(key)
+        try:
+            output = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.stats["misses"] += 1
+            return None
+
+        os.utime(path)  # most recently used
+        self.stats["hits"] += 1
+        return output
+
+    def put(self, key: str, output: np.ndarray) -> None:
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        # Written atomically, several inference processes may share the cache
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, output)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size += path.stat().st_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache is back to 90% of max_bytes."""
+        entries = []
+        for f in self.cache_dir.glob("*/*.npy"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            f.unlink(missing_ok=True)
+            self.size -= size
+            self.stats["evictions"] += 1
+
+    def report(self) -> None:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0.0
+        print(f"[INFO] Prediction cache: {self.stats['hits']} hits, {self.stats['misses']} misses "
+              f"({hit_rate * 100:.1f}% hit rate), {self.stats['evictions']} evictions, "
+              f"{self.size / 2 ** 30:.2f} GB in {self.cache_dir}")
+
+
+class CachedModel:
+    """
+    Serves the outputs of the cached input windows from a PredictionCache; only the windows missing from the
+    cache reach the model, and their outputs are added to the cache.
+    """
+
+    def __init__(self, model, cache: PredictionCache):
+        self.model = model
+        self.cache = cache
+
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        images = X.detach().cpu().numpy()
+        keys = [self.cache.key(image) for image in images]
+        cached = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, output in enumerate(cached) if output is None]
+        if missing:
+            outputs = self.model(X[missing]).float().cpu().numpy()
+            for i, output in zip(missing, outputs):
+                self.cache.put(keys[i], output)
+                cached[i] = output
+
+        return torch.from_numpy(np.stack(cached)).to(X.device)
+
+    @property
+    def warmup_seconds(self) -> float:
+        return getattr(self.model, "warmup_seconds", 0.0)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
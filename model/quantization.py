@@ -0,0 +1,181 @@
+from pathlib import Path
+import copy
+import inspect
+import platform
+
+import numpy as np
+import rasterio
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+from trainer import SemanticSegmentationTask
+from dataloader import GenMARSH
+
+
+def split_patch_indices(num_patches: int, calibration_samples: int, eval_samples: int = 0, seed: int = 0):
+    """Draws disjoint random calibration and held-out evaluation patch indices."""
+    indices = np.random.default_rng(seed).permutation(num_patches)
+    calibration = indices[:calibration_samples]
+    held_out = indices[calibration_samples:calibration_samples + eval_samples]
+    return calibration.tolist(), held_out.tolist()
+
+
+class TraceableSegmentationModel(nn.Module):
+    """
+    Encoder, decoder and segmentation head of a segmentation_models_pytorch network, without the input shape
+    check of SegmentationModel.forward: it branches on the input shape, which FX symbolic tracing cannot trace.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.segmentation_head = model.segmentation_head
+        # Older decoders take the encoder features as separate arguments, newer ones as a list
+        self.unpack_features = any(parameter.kind == inspect.Parameter.VAR_POSITIONAL
+                                   for parameter in inspect.signature(model.decoder.forward).parameters.values())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        features = self.encoder(x)
+        decoder_output = self.decoder(*features) if self.unpack_features else self.decoder(features)
+        return self.segmentation_head(decoder_output)
+
+
+def quantize_static(model: nn.Module, calibration_loader: DataLoader) -> nn.Module:
+    """
+    Static post-training INT8 quantization (FX graph mode): the activation ranges are calibrated on the
+    batches of calibration_loader.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = "qnnpack" if platform.machine().lower() in ("arm64", "aarch64") else "x86"
+    torch.backends.quantized.engine = engine
+
+    model = TraceableSegmentationModel(copy.deepcopy(model).cpu().eval()).eval()
+    example = next(iter(calibration_loader))["image"]
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(example,))
+
+    print(f"[INFO] Calibrating INT8 activations on {len(calibration_loader.dataset)} patches...")
+    with torch.no_grad():
+        for batch in calibration_loader:
+            prepared(batch["image"])
+
+    return convert_fx(prepared)
+
+
+def count_quantized_modules(model: nn.Module) -> int:
+    """Number of quantized operator modules (convolutions, linear layers, ...) of a converted model."""
+    return sum(type(module).__module__.startswith("torch.ao.nn.quantized") for module in model.modules())
+
+
+def quantize_model(model: nn.Module, calibration_loader: DataLoader) -> nn.Module:
+    """
+    Quantizes the network to INT8. Raises a RuntimeError when the network cannot be quantized, rather than
+    returning a float model that would be reported as INT8.
+    """
+    try:
+        quantized = quantize_static(model, calibration_loader)
+    except Exception as e:
+        print(f"[WARN] INT8 quantization failed, the model is NOT quantized: {e}")
+        raise RuntimeError("INT8 quantization failed, run with --precision fp32") from e
+
+    num_quantized = count_quantized_modules(quantized)
+    if num_quantized == 0:
+        print("[WARN] INT8 quantization left every layer in float32, the model is NOT quantized")
+        raise RuntimeError("INT8 quantization did not quantize any layer, run with --precision fp32")
+
+    print(f"[INFO] INT8 model with {num_quantized} quantized layers")
+    return quantized
+
+
+def build_int8_model(task: SemanticSegmentationTask, dataset, calibration_samples: int = 256,
+                     batch_size: int = 32) -> nn.Module:
+    """
+    Quantizes the network of a task, calibrated on a random sample of the dataset to infer.
+
+    :param batch_size: calibration batch size, the inference batch size so large windows stay within the memory budget
+    """
+    calibration, _ = split_patch_indices(len(dataset), calibration_samples)
+    loader = DataLoader(Subset(dataset, calibration), batch_size=batch_size, shuffle=False)
+    return quantize_model(task.model, loader)
+
+
+def read_label(labels_folder: Path, filename: str) -> torch.Tensor:
+    """Reads the label patch (1=marsh, 0=non-marsh) with the same file name as the image patch."""
+    with rasterio.open(Path(labels_folder) / filename) as src:
+        return torch.from_numpy(src.read(1).astype("int64"))
+
+
+def evaluate_parity(task: SemanticSegmentationTask, int8_model: nn.Module, loader: DataLoader,
+                    labels_folder: Path = None) -> dict:
+    """
+    Compares the INT8 model with the float model on held-out patches, using the binary metrics of the task.
+
+    With labels, both models are scored against the labels and the deltas are reported. Without labels, the
+    INT8 predictions are scored against the float predictions.
+    """
+    float_metrics = task.test_metrics.clone(prefix="float_")
+    int8_metrics = task.test_metrics.clone(prefix="int8_")
+
+    with torch.no_grad():
+        for batch in loader:
+            X = batch["image"]
+            float_preds = task.model(X).argmax(dim=1)
+            int8_preds = int8_model(X).argmax(dim=1)
+
+            if labels_folder is None:
+                int8_metrics(int8_preds, float_preds)
+            else:
+                target = torch.stack([read_label(labels_folder, fname) for fname in batch["filename"]])
+                float_metrics(float_preds, target)
+                int8_metrics(int8_preds, target)
+
+    results = {name: value.item() for name, value in int8_metrics.compute().items()}
+
+    if labels_folder is None:
+        print("[INFO] INT8 predictions scored against the float predictions:")
+        for name, value in results.items():
+            print(f"[INFO]   {name:<24} {value:.4f}")
+        return results
+
+    float_results = {name: value.item() for name, value in float_metrics.compute().items()}
+    results.update(float_results)
+    print("[INFO] Float vs INT8 against the labels:")
+    for float_name, float_value in float_results.items():
+        metric = float_name[len("float_"):]
+        int8_value = results[f"int8_{metric}"]
+        results[f"delta_{metric}"] = int8_value - float_value
+        print(f"[INFO]   {metric:<20} float {float_value:.4f}  int8 {int8_value:.4f}  delta {int8_value - float_value:+.4f}")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check the accuracy of the INT8 quantized model against the float model.")
+    parser.add_argument("checkpoint", type=str, help="Path to the checkpoint, e.g. weights/sentinel/unet/last.ckpt")
+    parser.add_argument("patches", type=str, help="Folder of image patches (GeoTIFF patches or patch store)")
+    parser.add_argument("--labels", type=str, default=None, help="Folder of label patches with the same file names")
+    parser.add_argument("--datasource", choices=["sentinel", "NAIP"], default="sentinel", help="Imagery source")
+    parser.add_argument("--calibration-samples", type=int, default=256, help="Number of calibration patches")
+    parser.add_argument("--eval-samples", type=int, default=1024, help="Number of held-out evaluation patches")
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of patches per batch")
+
+    args = parser.parse_args()
+
+    task = SemanticSegmentationTask.load_from_checkpoint(args.checkpoint, map_location="cpu")
+    task.eval()
+
+    if args.datasource == "NAIP":
+        dataset = GenMARSH(args.patches, ndwi=False, datasource="NAIP")
+    else:
+        dataset = GenMARSH(args.patches, mode="test")
+
+    calibration, held_out = split_patch_indices(len(dataset), args.calibration_samples, args.eval_samples)
+    calibration_loader = DataLoader(Subset(dataset, calibration), batch_size=args.batch_size, shuffle=False)
+    eval_loader = DataLoader(Subset(dataset, held_out), batch_size=args.batch_size, shuffle=False)
+
+    int8_model = quantize_model(task.model, calibration_loader)
+    evaluate_parity(task, int8_model, eval_loader, args.labels)
@@ -0,0 +1,291 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+
+import torch
+from torch.utils.data import Subset
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from processing.stitching import PredictionAccumulator
+from dataloader import GenMARSHWindows, PATCH_INDEX
+from prediction_cache import file_digest
+from inference import load_inference_model, make_dataloader, run_pipelined_inference, PatchWriter, AccumulatorWriter
+
+# Assignment of the sample ranges to the shards, written next to the shard outputs and completion markers
+MANIFEST = "manifest.json"
+
+
+def shard_indices(num_samples: int, num_shards: int, shard: int) -> range:
+    """Contiguous slice of the patch (or window) indices processed by a shard, so neighbouring windows stay together."""
+    start = num_samples * shard // num_shards
+    stop = num_samples * (shard + 1) // num_shards
+    return range(start, stop)
+
+
+# Cores available to a worker process before it pins itself to the cores of its shard
+_worker_cores = None
+
+
+def init_worker(threads: int) -> None:
+    """
+    Pool initializer: sets the threads of a worker process once, the pool reuses its processes across shards
+    and torch only allows setting the inter-op threads once per process.
+    """
+    global _worker_cores
+
+    # The shards share the CPU cores, they do not compete for the GPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    if hasattr(os, "sched_getaffinity"):
+        _worker_cores = sorted(os.sched_getaffinity(0))
+
+
+def pin_cores(shard: int, threads: int) -> None:
+    """Where supported, limits the process to the cores of its shard."""
+    if _worker_cores is not None:
+        own = _worker_cores[shard * threads:(shard + 1) * threads]
+        if len(own) == threads:
+            os.sched_setaffinity(0, own)
+
+
+def shard_rows(dataset: GenMARSHWindows, start: int, stop: int):
+    """Band of grid rows (row offset, number of rows) covered by the windows start to stop of a dataset."""
+    windows = dataset.windows[start:stop]
+    if not windows:
+        # Empty shard: a single row without weight, memory maps cannot be empty
+        return 0, 1
+    height = dataset.profile["height"]
+    row_off = min(int(window.row_off) for window in windows)
+    row_stop = min(max(int(window.row_off + window.height) for window in windows), height)
+    return row_off, row_stop - row_off
+
+
+def shard_root_for(output: Path) -> Path:
+    """Folder holding the manifest, the shard outputs and their completion markers, next to the output."""
+    output = Path(output)
+    return output.parent / f"{output.stem}_shards"
+
+
+def shard_output(shard_root: Path, shard: int) -> Path:
+    return Path(shard_root) / f"shard_{shard:04d}"
+
+
+def marker_path(shard_root: Path, shard: int) -> Path:
+    return Path(shard_root) / f"shard_{shard:04d}.done"
+
+
+def describe_source(dataset) -> dict:
+    """
+    Identifies the samples of a dataset by content, so a manifest is only reused for the same patches or window
+    grid, whatever the path the shared filesystem is mounted at on each machine.
+    """
+    if isinstance(dataset, GenMARSHWindows):
+        profile = dataset.profile
+        windows = hashlib.sha256(json.dumps(
+            [[int(w.col_off), int(w.row_off), int(w.width), int(w.height)] for w in dataset.windows]).encode())
+        return {"width": profile["width"], "height": profile["height"], "transform": list(profile["transform"])[:6],
+                "patch_size": dataset.patch_size, "halo": dataset.halo, "windows": windows.hexdigest()}
+
+    index_path = Path(dataset.folder_path) / PATCH_INDEX
+    if index_path.is_file():
+        return {"patch_index": file_digest(index_path)}
+    names = hashlib.sha256("\n".join(os.path.basename(str(name)) for name in dataset.image_files).encode())
+    return {"patch_names": names.hexdigest()}
+
+
+def load_or_create_manifest(shard_root: Path, dataset, num_shards: int) -> dict:
+    """
+    Reads the manifest assigning the sample ranges (rows of patch_index.csv or windows of the grid) to the
+    shards, or writes it if it does not exist yet. The ranges only depend on the number of samples and shards,
+    so every machine computes the same assignment.
+    """
+    ranges = [shard_indices(len(dataset), num_shards, shard) for shard in range(num_shards)]
+    manifest = {
+        "source": describe_source(dataset),
+        "num_samples": len(dataset),
+        "num_shards": num_shards,
+        "shards": [{"shard": shard, "start": r.start, "stop": r.stop} for shard, r in enumerate(ranges)]
+    }
+
+    path = Path(shard_root) / MANIFEST
+    if path.is_file():
+        with open(path) as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError(f"The manifest {path} was written for other samples or another number of shards, "
+                             f"remove {shard_root} to start over.")
+        return existing
+
+    # Written atomically, several machines may create it at the same time
+    Path(shard_root).mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def infer_shard(checkpoint_path: Path, dataset, output: Path, shard: int, num_shards: int, batch_size: int = 32,
+                model_options: dict = None, num_workers: int = 4, writer_workers: int = 2, num_classes: int = 2,
+                progress=None) -> dict:
+    """
+    Runs the inference of one shard of the manifest and writes its completion marker.
+
+    The patch predictions are written to the shared output folder. The window probabilities are accumulated
+    into the shard folder, to be summed with the other shards by merge_shards. A shard without its marker
+    (failed or interrupted) is simply run again.
+    """
+    shard_root = shard_root_for(output)
+    manifest = load_or_create_manifest(shard_root, dataset, num_shards)
+    entry = manifest["shards"][shard]
+
+    if marker_path(shard_root, shard).is_file():
+        print(f"[INFO] Shard {shard}/{num_shards} is already done, skipping.")
+        return {}
+
+    start = time.perf_counter()
+    model, device = load_inference_model(checkpoint_path, dataset, batch_size=batch_size, **(model_options or {}))
+    dataloader = make_dataloader(Subset(dataset, range(entry["start"], entry["stop"])), batch_size, num_workers)
+
+    print(f"[INFO] Shard {shard}/{num_shards}: samples {entry['start']} to {entry['stop']}")
+    if isinstance(dataset, GenMARSHWindows):
+        # The accumulator only covers the rows reached by the windows of the shard
+        row_off, rows = shard_rows(dataset, entry["start"], entry["stop"])
+        accumulator = PredictionAccumulator(dataset.profile, num_classes, directory=shard_output(shard_root, shard),
+                                            row_off=row_off, rows=rows)
+        writer = AccumulatorWriter(accumulator, dataset.halo)
+        stats = run_pipelined_inference(model, dataloader, writer, device, writer_workers, progress=progress)
+        accumulator.close()
+    else:
+        writer = PatchWriter(dataset, output)
+        stats = run_pipelined_inference(model, dataloader, writer, device, writer_workers, progress=progress)
+
+    with open(marker_path(shard_root, shard), "w") as f:
+        json.dump({"shard": shard, "samples": stats["samples"], "seconds": time.perf_counter() - start}, f)
+
+    return stats
+
+
+def merge_shards(dataset, output: Path, num_classes: int = 2, cleanup: bool = True) -> None:
+    """
+    Combines the finished shards of the manifest. The window accumulators are summed in shard order, so the
+    merged raster does not depend on which machine finished first; the patch predictions already share the
+    output folder and are stitched by the caller.
+
+    :raises RuntimeError: if some shards have no completion marker, they are listed to be rerun
+    """
+    output = Path(output)
+    shard_root = shard_root_for(output)
+    manifest_path = shard_root / MANIFEST
+    if not manifest_path.is_file():
+        raise FileNotFoundError(f"No manifest found in {shard_root}, run the shards first.")
+
+    with open(manifest_path) as f:
+        num_shards = json.load(f)["num_shards"]
+
+    missing = [shard for shard in range(num_shards) if not marker_path(shard_root, shard).is_file()]
+    if missing:
+        raise RuntimeError(f"Shards {missing} of {num_shards} are not finished, rerun each of them with "
+                           f"--shard <i>/{num_shards} before merging.")
+
+    if isinstance(dataset, GenMARSHWindows):
+        print(f"[INFO] Merging {num_shards} shards into: {output}")
+        with PredictionAccumulator(dataset.profile, num_classes, work_dir=output.parent) as accumulator:
+            for shard in range(num_shards):
+                accumulator.add_from(shard_output(shard_root, shard))
+            accumulator.flush(output)
+    else:
+        print(f"[INFO] All {num_shards} shards are done, predictions in: {output}")
+
+    if cleanup:
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+
+def run_shard(checkpoint_path: Path, dataset, output: Path, shard: int, num_shards: int, threads: int = 1,
+              batch_size: int = 32, model_options: dict = None, writer_workers: int = 2, num_classes: int = 2,
+              progress_queue=None) -> dict:
+    """Runs a shard in a local worker process (see init_worker), with its own model copy and pinned cores."""
+    # A done shard returns at once, its worker may then run another shard
+    if marker_path(shard_root_for(output), shard).is_file():
+        print(f"[INFO] Shard {shard}/{num_shards} is already done, skipping.")
+        return {}
+
+    pin_cores(shard, threads)
+
+    model_options = dict(model_options or {})
+    model_options["intra_op_threads"] = threads
+
+    def progress(samples):
+        if progress_queue is not None:
+            progress_queue.put(samples)
+
+    return infer_shard(checkpoint_path, dataset, output, shard, num_shards, batch_size, model_options,
+                       num_workers=1, writer_workers=writer_workers, num_classes=num_classes, progress=progress)
+
+
+def run_sharded_inference(checkpoint_path: Path, dataset, output: Path, processes: int, batch_size: int = 32,
+                          model_options: dict = None, writer_workers: int = 2, num_classes: int = 2) -> None:
+    """
+    Splits the patches (or windows) into one shard per process and runs them in parallel, each process with its
+    own model copy and cores, so the throughput scales with the number of cores instead of intra-op threading.
+    The shards follow the same manifest as the multi-machine runs, so an interrupted run only reruns the shards
+    without a completion marker.
+
+    :param checkpoint_path: Lightning checkpoint, loaded by every process
+    :param dataset: GenMARSH or GenMARSHWindows dataset
+    :param output: folder of the patch predictions for GenMARSH, output GeoTIFF for GenMARSHWindows
+    :param processes: number of worker processes
+    :param model_options: keyword arguments of load_inference_model (backend, precision, fast, ...)
+    """
+    output = Path(output)
+    if not isinstance(dataset, GenMARSHWindows):
+        output.mkdir(parents=True, exist_ok=True)
+
+    threads = max((os.cpu_count() or 1) // processes, 1)
+    load_or_create_manifest(shard_root_for(output), dataset, processes)
+
+    print(f"[INFO] Running {len(dataset)} samples in {processes} processes of {threads} threads...")
+    start = time.perf_counter()
+    done = 0
+
+    # spawn: every worker imports torch afresh and sets its own thread count
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                                           initializer=init_worker, initargs=(threads,)) as executor:
+        progress_queue = manager.Queue()
+        pending = {
+            executor.submit(run_shard, checkpoint_path, dataset, output, shard, processes, threads, batch_size,
+                            model_options, writer_workers, num_classes, progress_queue)
+            for shard in range(processes)
+        }
+
+        while pending:
+            finished, pending = wait(pending, timeout=5, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+
+            while True:
+                try:
+                    done += progress_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            elapsed = time.perf_counter() - start
+            print(f"[INFO] {done}/{len(dataset)} samples ({done / max(elapsed, 1e-9):.1f} samples/s), "
+                  f"{processes - len(pending)}/{processes} shards done")
+
+    merge_shards(dataset, output, num_classes)
+
+    elapsed = time.perf_counter() - start
+    print(f"[INFO] {done} samples in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} samples/s)")
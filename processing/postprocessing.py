@@ -1,46 +1,103 @@
-
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from util import read_multiband_image, create_land_water_mask, compute_ndwi, read_band, mask_marsh_prediction, save_raster
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+from util import create_land_water_mask, compute_ndwi, mask_marsh_prediction, TILED_GTIFF_PROFILE
+
+# 1-based (green, NIR) band indexes of the raw imagery
+NDWI_BANDS = {
+    "naip": (2, 4),      # R, G, B, NIR
+    "sentinel": (2, 7),  # B02, B03, B04, B05, B06, B07, B08, B8A, B11, B12
+}
+
+
+def clean_block(raw, pred, window, bands, ndwi_threshold: float) -> np.ndarray:
+    """
+    Removes the water pixels from a window of the prediction.
+
+    The green and NIR bands are read from the window of the raw image covering the same geographic bounds,
+    resampled onto the prediction grid, so the two rasters do not need to share their extent or resolution.
+    """
+    marsh_pred = pred.read(1, window=window)
+
+    raw_window = raw.window(*pred.window_bounds(window))
+    # A boundless read goes through a WarpedVRT, only use it when the window leaves the raw image
+    outside = (raw_window.col_off < 0 or raw_window.row_off < 0 or
+               raw_window.col_off + raw_window.width > raw.width or raw_window.row_off + raw_window.height > raw.height)
+    green, nir = raw.read(bands, window=raw_window, out_shape=(2, marsh_pred.shape[0], marsh_pred.shape[1]),
+                          boundless=outside, fill_value=0, resampling=Resampling.nearest)
+
+    ndwi = compute_ndwi(green, nir)
+    land_mask = create_land_water_mask(ndwi, threshold=ndwi_threshold)
+    cleaned_marsh = mask_marsh_prediction(marsh_pred, land_mask)
+
+    if pred.nodata is not None:
+        cleaned_marsh[marsh_pred == pred.nodata] = pred.nodata
+
+    return cleaned_marsh
 
 
 def process_marsh_mask(raw_image_path: Path,
                        marsh_pred_path: Path,
                        output_path: Path,
                        image_source: str,
-                       ndwi_threshold: float = 0.5) -> None:
+                       ndwi_threshold: float = 0.5,
+                       workers: int = 4) -> None:
     """
     Clean marsh prediction mask by removing areas classified as water based on NDWI.
 
+    The prediction is processed block by block, reading only the green and NIR bands of the raw image, so
+    neither raster needs to fit in memory. The blocks are cleaned in parallel threads and written in order.
+
     Args:
         raw_image_path (Path): Path to 4-band input image (RGB + NIR).
         marsh_pred_path (Path): Path to binary marsh prediction (1=marsh, 0=non-marsh).
         output_path (Path): Path to save cleaned marsh mask.
+        image_source (str): "naip" or "sentinel", sets the green and NIR bands of the raw image.
         ndwi_threshold (float): Threshold for land/water separation using NDWI.
+        workers (int): Number of threads cleaning blocks in parallel.
     """
+    bands = list(NDWI_BANDS[image_source.lower()])
 
-    print(f"[INFO] Reading raw image from: {raw_image_path}")
-    raw = read_multiband_image(raw_image_path)
-    if image_source.lower() == "naip":
-        green = raw[1]  # Band 2: Green (0-based index 1)
-        nir = raw[3]    # Band 4: NIR   (0-based index 3)
-    elif image_source.lower() == "sentinel":
-        green = raw[1]  # Band 2: Green (0-based index 1)
-        nir = raw[6]
-
-    print("[INFO] Computing NDWI...")
-    ndwi = compute_ndwi(green, nir)
+    # Every thread keeps its own dataset handles
+    local = threading.local()
+    handles = []
 
-    print(f"[INFO] Creating land/water mask using threshold: {ndwi_threshold}")
-    land_mask = create_land_water_mask(ndwi, threshold=ndwi_threshold)
+    def process(window):
+        if not hasattr(local, "raw"):
+            local.raw = rasterio.open(raw_image_path)
+            local.pred = rasterio.open(marsh_pred_path)
+            handles.extend([local.raw, local.pred])
+        return window, clean_block(local.raw, local.pred, window, bands, ndwi_threshold)
 
+    print(f"[INFO] Reading raw image from: {raw_image_path}")
     print(f"[INFO] Reading marsh prediction from: {marsh_pred_path}")
-    marsh_pred = read_band(marsh_pred_path, band_index=1)  # assuming it's single-band
-
-    print("[INFO] Applying land mask to marsh prediction...")
-    cleaned_marsh = mask_marsh_prediction(marsh_pred, land_mask)
+    with rasterio.open(marsh_pred_path) as pred:
+        profile = pred.profile.copy()
+        profile.update(TILED_GTIFF_PROFILE)
+        profile.update({
+            'count': 1,
+            'dtype': 'uint8'
+        })
 
     print(f"[INFO] Saving cleaned marsh prediction to: {output_path}")
-    save_raster(output_path, cleaned_marsh, reference_raster=marsh_pred_path)
+    with rasterio.open(output_path, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=workers) as executor:
+        # The 512 x 512 tiles of the output, whatever the block layout of the prediction (often one-row strips)
+        windows = [window for _, window in dst.block_windows(1)]
+        print(f"[INFO] Masking water (NDWI >= {ndwi_threshold}) from {len(windows)} blocks...")
+
+        # Submit the blocks in chunks to bound the number of blocks held in memory
+        chunk = 4 * workers
+        for i in range(0, len(windows), chunk):
+            for window, cleaned_marsh in executor.map(process, windows[i:i + chunk]):
+                dst.write(cleaned_marsh.astype('uint8'), 1, window=window)
+
+    for handle in handles:
+        handle.close()
 
     print("[INFO] Done.")
 
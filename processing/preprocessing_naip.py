@@ -8,6 +8,12 @@ project_root = Path(__file__).resolve().parent.parent
 year = "2022"
 tile_name = "m_3707654_sw_18_060_20210913.tif"
 
+# "tif" saves every patch as a GeoTIFF, "npy" saves all the patches into a single memory-mapped file
+patch_store = "tif"
+
+# Patches with a lower fraction of valid (non-nodata) pixels are skipped, e.g. ocean or outside the AOI
+min_valid_fraction = 0.01
+
 input_stem = tile_name.split('.')[0]
 
 raw_tile_path = os.path.join(project_root, "dataset/raw/NAIP/{}/{}".format(year, tile_name))
@@ -20,6 +26,7 @@ b_path = os.path.join(project_root, "dataset/processed/NAIP_{}".format(year))
 output_dir = os.path.join(b_path, "{}_patches".format(input_stem))
 
 # Image patch generation
-split_and_save_patches(raw_tile_path, output_dir, patch_size=256, overlap=30, skip_partial=True)
+split_and_save_patches(raw_tile_path, output_dir, patch_size=256, overlap=30, skip_partial=True, store=patch_store,
+                       min_valid_fraction=min_valid_fraction)
 
 
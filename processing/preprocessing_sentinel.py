@@ -1,14 +1,23 @@
-
-
 import os
-import rasterio
 from pathlib import Path
-from util import re_projection, create_mosaic, merge_bands_to_multispectral, split_and_save_patches, reproject_to_match
-import glob
+from util import crop_to_aoi, merge_bands_to_multispectral, split_and_save_patches, build_multispectral_stack, reproject_and_mosaic_bands
 
 year = "2018"
 AOI = "aoi"
 
+# By default the bands are warped, mosaicked and stacked in a single pass without intermediate files.
+# Set to True to also save the reprojected bands ('reprojection' folder) and the band mosaics (merge_B*.tif).
+keep_intermediates = False
+
+# "tif" saves every patch as a GeoTIFF, "npy" saves all the patches into a single memory-mapped file
+patch_store = "tif"
+
+# Patches with a lower fraction of valid (non-nodata) pixels are skipped, e.g. ocean or outside the AOI
+min_valid_fraction = 0.01
+
+# Number of processes reprojecting the granule bands when keeping the intermediates, defaults to the number of CPUs
+workers = None
+
 project_root = Path(__file__).resolve().parent.parent
 
 # The data are saved to different subfolder name depending on the year
@@ -17,61 +26,51 @@ if int(year) >= 2022:
 else:
     raw_data_path = Path(os.path.join(project_root, "dataset/raw/Sentinel-2/MSI/L2A_N0500/{}".format(year)))
 
-# aoi_path = os.path.join(base_path, "bounding_box.geojson")
+# AOI boundary (.geojson or .shp), e.g. os.path.join(project_root, "dataset/raw/guinea_marsh.geojson").
+# When set, only the AOI is processed: the output covers the AOI bounds, the granules outside the AOI are skipped,
+# only the granule pixels under the AOI are read and warped, and the pixels outside the AOI are set to nodata.
+# None processes the full extent of all granules.
+aoi_path = None
 
 b_path = os.path.join(project_root, "dataset/processed/sentinel_{}_{}".format(AOI, year))
 
-# Setting up different directories for the data
-(project_root / 'dataset' / 'processed' /'sentinel_{}_{}'.format(AOI, year)).mkdir(exist_ok=True, parents=True)
-(project_root / 'dataset' /'processed' / 'sentinel_{}_{}'.format(AOI, year) / 'reprojection').mkdir(exist_ok=True, parents=True)
-reproject_path = os.path.join(b_path, 'reprojection')
-
 merge_output_path = os.path.join(b_path, "combined_{}_{}.tif".format(AOI, year))
 
 output_dir = os.path.join(b_path, "patches")
 
 band_list = ["02", "03", "04", "05", "06", "07", "08" ,"8A", "11", "12"] # getting the band list
 res_list = ["10", "10", "10", "20", "20", "20", "10", "20", "20", "20"] # getting the corresponding resolution
-all_bands_path = []
-
-mosaic_path_list = []
-for b, res in zip(band_list, res_list):
-
-    print("Working on band {}".format(b))
-    band_granules_path = list(raw_data_path.rglob("*B{}_{}m.jp2".format(b, res)))
-
-    band_granules_src = [rasterio.open(i, driver='JP2OpenJPEG') for i in band_granules_path]
-
-    proj_band_path = [os.path.join(reproject_path, Path(i).stem + '_wgs84.tif') for i in band_granules_path]
-
-    all_bands_path.append(proj_band_path[0])
 
-    # Reproject all bands to wgs-84
-    for file, outfile in zip(band_granules_path, proj_band_path):
 
-        infilename = os.path.basename(file).split('.')[0]
-        outfilename_pre = os.path.basename(outfile).split('.')[0][0:-6]
+def main():
 
-        if infilename == outfilename_pre and not os.path.isfile(outfile):
-            print("Reproject file {}".format(file))
+    # Setting up different directories for the data
+    (project_root / 'dataset' / 'processed' /'sentinel_{}_{}'.format(AOI, year)).mkdir(exist_ok=True, parents=True)
 
-            # standardize all band resolution to 10m resolution, default is 0.000103632
-            if b == "02":
-                re_projection(file, outfile)
-                reference_path = outfile
-            else:
-                reproject_to_match(file, outfile, reference_path)
+    if not keep_intermediates:
+        # Warp every granule band on the fly, mosaic and stack them block by block into the multispectral imagery
+        band_granules = [sorted(raw_data_path.rglob("*B{}_{}m.jp2".format(b, res))) for b, res in zip(band_list, res_list)]
+        build_multispectral_stack(band_granules, merge_output_path, aoi_path=aoi_path)
 
-    mosaic_path = Path(b_path) / 'merge_B{}_{}.tif'.format(b, year)
-    create_mosaic(proj_band_path, mosaic_path)
+    else:
+        (project_root / 'dataset' /'processed' / 'sentinel_{}_{}'.format(AOI, year) / 'reprojection').mkdir(exist_ok=True, parents=True)
+        reproject_path = os.path.join(b_path, 'reprojection')
 
-    mosaic_path_list.append(mosaic_path) # get all individual band path for band stacking
+        # Reproject all bands to wgs-84 (B02 of every granule first, then the other bands onto its grid)
+        # across a process pool, and mosaic every band as soon as all its granules are done
+        mosaic_path_list = reproject_and_mosaic_bands(raw_data_path, band_list, res_list, reproject_path, b_path, year, workers)
 
-# Merge all band information into a multispectral imagery
-merge_bands_to_multispectral(mosaic_path_list, merge_output_path)
+        # Merge all band information into a multispectral imagery
+        merge_bands_to_multispectral(mosaic_path_list, merge_output_path, read_workers=len(band_list))
 
-# Image patch generation
-split_and_save_patches(merge_output_path, output_dir, patch_size=128, overlap=10, skip_partial=True)
+        # The intermediates cover the full granules, only the final imagery is cropped to the AOI
+        if aoi_path is not None:
+            crop_to_aoi(merge_output_path, aoi_path, merge_output_path)
 
+    # Image patch generation
+    split_and_save_patches(merge_output_path, output_dir, patch_size=128, overlap=10, skip_partial=True, store=patch_store,
+                           min_valid_fraction=min_valid_fraction)
 
 
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 
+import json
 import os
+import shutil
+import tempfile
+import threading
 import rasterio
+import numpy as np
 from rasterio.merge import merge
+from rasterio.windows import Window
 import argparse
+from affine import Affine
+from concurrent.futures import ProcessPoolExecutor
 
-def stitch_tiff_patches(input_dir, output_path):
-    """Stitch GeoTIFF patches into a single mosaic."""
+
+def stitch_tiff_patches(input_dir, output_path, chunked=False, block_size=2048, max_open_files=64, workers=None):
+    """
+    Stitch GeoTIFF patches into a single mosaic.
+
+    By default all the patches are opened at once and merged with rasterio. With chunked=True, every patch is
+    placed at its offset into a pre-allocated tiled output instead, see stitch_tiff_patches_chunked.
+    """
     # Find all .tif files in the directory
     tif_files = [
         os.path.join(input_dir, f)
@@ -13,6 +27,10 @@ def stitch_tiff_patches(input_dir, output_path):
         if f.lower().endswith(".tif")
     ]
 
+    if chunked:
+        stitch_tiff_patches_chunked(tif_files, output_path, block_size, max_open_files, workers)
+        return
+
     # Open all the datasets
     src_files_to_mosaic = [rasterio.open(fp) for fp in tif_files]
 
@@ -36,12 +54,276 @@ def stitch_tiff_patches(input_dir, output_path):
     print(f"Stitched image saved to: {output_path}")
 
 
+def _read_patch_headers(tif_files):
+    """Reads the bounds of a group of patches, opening one file at a time."""
+    headers = []
+    for fp in tif_files:
+        with rasterio.open(fp) as src:
+            headers.append((fp, tuple(src.bounds)))
+    return headers
+
+
+def _build_block(patches, row_off, col_off, height, width, count, dtype, nodata):
+    """
+    Places the patches intersecting a tile of the output into an array, opening one file at a time.
+    The first patch covering a pixel wins, like the default rasterio merge.
+    """
+    block = np.full((count, height, width), 0 if nodata is None else nodata, dtype=dtype)
+    filled = np.zeros((height, width), dtype=bool)
+
+    for fp, patch_row, patch_col in patches:
+        with rasterio.open(fp) as src:
+            data = src.read(masked=True)
+
+        # Crop the patch to the tile
+        top = max(patch_row, row_off)
+        bottom = min(patch_row + data.shape[1], row_off + height)
+        left = max(patch_col, col_off)
+        right = min(patch_col + data.shape[2], col_off + width)
+        data = data[:, top - patch_row:bottom - patch_row, left - patch_col:right - patch_col]
+
+        valid = ~np.ma.getmaskarray(data).all(axis=0)
+        target = (slice(top - row_off, bottom - row_off), slice(left - col_off, right - col_off))
+        place = valid & ~filled[target]
+
+        block[(slice(None),) + target][:, place] = np.ma.getdata(data)[:, place]
+        filled[target] |= place
+
+    return row_off, col_off, block
+
+
+def stitch_tiff_patches_chunked(tif_files, output_path, block_size=2048, max_open_files=64, workers=None,
+                                max_blocks_in_flight=8):
+    """
+    Stitch GeoTIFF patches by placing them at their window offset into a pre-allocated tiled output.
+
+    The output grid is split into block_size x block_size tiles that are built in parallel across a process pool.
+    Every worker opens a single patch at a time, so the open handles are capped by max_open_files, and at most
+    max_blocks_in_flight tiles are held in memory whatever the number of CPUs and the width of the mosaic.
+
+    :param tif_files: list of GeoTIFF patches, sharing the same CRS and resolution
+    :param output_path: output path for the stitched GeoTIFF
+    :param block_size: number of output rows and columns per tile
+    :param max_open_files: maximum number of files opened at once
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param max_blocks_in_flight: maximum number of tiles built or waiting to be written
+    """
+    workers = max(1, min(workers or os.cpu_count() or 1, max_open_files - 1))
+
+    with rasterio.open(tif_files[0]) as src:
+        out_meta = src.meta.copy()
+        res_x, res_y = src.res
+
+    # Read the patch bounds in groups, to derive the output grid and the offset of every patch
+    groups = [tif_files[i:i + 1000] for i in range(0, len(tif_files), 1000)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        headers = [header for group in executor.map(_read_patch_headers, groups) for header in group]
+
+    left = min(bounds[0] for _, bounds in headers)
+    bottom = min(bounds[1] for _, bounds in headers)
+    right = max(bounds[2] for _, bounds in headers)
+    top = max(bounds[3] for _, bounds in headers)
+
+    width = int(round((right - left) / res_x))
+    height = int(round((top - bottom) / res_y))
+    out_transform = Affine(res_x, 0.0, left, 0.0, -res_y, top)
+
+    # Assign every patch to the tiles it intersects, keeping the file order for first-wins placement
+    block_patches = {}
+    for fp, bounds in headers:
+        patch_col = int(round((bounds[0] - left) / res_x))
+        patch_row = int(round((top - bounds[3]) / res_y))
+        patch_width = int(round((bounds[2] - bounds[0]) / res_x))
+        patch_height = int(round((bounds[3] - bounds[1]) / res_y))
+        for row_off in range(max(patch_row, 0) // block_size * block_size, min(patch_row + patch_height, height), block_size):
+            for col_off in range(max(patch_col, 0) // block_size * block_size, min(patch_col + patch_width, width), block_size):
+                block_patches.setdefault((row_off, col_off), []).append((fp, patch_row, patch_col))
+
+    out_meta.update({
+        "driver": "GTiff",
+        "height": height,
+        "width": width,
+        "transform": out_transform,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "compress": "lzw"
+    })
+
+    def write(future):
+        done_row_off, done_col_off, block = future.result()
+        dest.write(block, window=Window(done_col_off, done_row_off, block.shape[2], block.shape[1]))
+
+    workers = min(workers, max_blocks_in_flight)
+    with rasterio.open(output_path, "w", **out_meta) as dest, ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for row_off in range(0, height, block_size):
+            for col_off in range(0, width, block_size):
+                patches = block_patches.get((row_off, col_off), [])
+                pending.append(executor.submit(_build_block, patches, row_off, col_off, min(block_size, height - row_off),
+                                               min(block_size, width - col_off), out_meta["count"], out_meta["dtype"],
+                                               out_meta["nodata"]))
+
+                # Keep a bounded number of tiles in flight
+                if len(pending) >= max_blocks_in_flight:
+                    write(pending.pop(0))
+
+        for future in pending:
+            write(future)
+
+    print(f"Stitched image saved to: {output_path}")
+
+
+class PredictionAccumulator:
+    """
+    Disk-backed accumulator of the per-class probabilities over the output grid.
+
+    The per-pixel probability sums and weights are kept in memory-mapped arrays, so overlapping windows are
+    averaged instead of first-wins, the memory use stays bounded by the OS page cache and no prediction file is
+    opened until the single output GeoTIFF is flushed.
+
+    The arrays live in a temporary directory under work_dir, unless a directory is given: they are then kept on
+    close, so the accumulators of several inference shards can be summed with add_from before flushing.
+
+    An accumulator may only cover a band of rows of the grid (row_off, rows), e.g. the rows reached by the
+    windows of an inference shard; the band is recorded in its directory for add_from.
+    """
+
+    BAND = "band.json"
+
+    def __init__(self, profile: dict, num_classes: int = 2, work_dir=None, directory=None, row_off: int = 0,
+                 rows: int = None):
+        self.profile = profile.copy()
+        self.height = profile["height"]
+        self.width = profile["width"]
+        self.num_classes = num_classes
+        self.row_off = row_off
+        self.rows = self.height - row_off if rows is None else rows
+
+        self.keep = directory is not None
+        if self.keep:
+            os.makedirs(directory, exist_ok=True)
+            self.work_dir = str(directory)
+            with open(os.path.join(self.work_dir, self.BAND), "w") as f:
+                json.dump({"row_off": self.row_off, "rows": self.rows}, f)
+        else:
+            self.work_dir = tempfile.mkdtemp(prefix="accumulator_", dir=work_dir)
+        self.sums = np.lib.format.open_memmap(os.path.join(self.work_dir, "sums.npy"), mode="w+", dtype="float32",
+                                              shape=(num_classes, self.rows, self.width))
+        self.weights = np.lib.format.open_memmap(os.path.join(self.work_dir, "weights.npy"), mode="w+",
+                                                 dtype="float32", shape=(self.rows, self.width))
+
+        # Windows may be added from several writer threads
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, probs: np.ndarray, window: Window, weight: float = 1.0) -> None:
+        """
+        Adds the class probabilities (CxHxW) of a window, cropping whatever falls outside the output grid
+        or the rows of the accumulator.
+        """
+        col_off, row_off = int(window.col_off), int(window.row_off) - self.row_off
+        top = max(row_off, 0)
+        bottom = min(row_off + int(window.height), self.rows)
+        width = min(int(window.width), self.width - col_off)
+        if bottom <= top:
+            return
+
+        with self._lock:
+            self.sums[:, top:bottom, col_off:col_off + width] += probs[:, top - row_off:bottom - row_off, :width] * weight
+            self.weights[top:bottom, col_off:col_off + width] += weight
+
+    def add_from(self, directory, block_size: int = 1024) -> None:
+        """Adds the sums and weights kept by another accumulator over the same grid, only over its band of rows."""
+        sums = np.load(os.path.join(directory, "sums.npy"), mmap_mode="r")
+        weights = np.load(os.path.join(directory, "weights.npy"), mmap_mode="r")
+
+        band_path = os.path.join(directory, self.BAND)
+        band = {"row_off": 0, "rows": weights.shape[0]}
+        if os.path.isfile(band_path):
+            with open(band_path) as f:
+                band = json.load(f)
+
+        offset = band["row_off"] - self.row_off
+        if (sums.shape[0] != self.num_classes or weights.shape != (band["rows"], self.width)
+                or offset < 0 or offset + band["rows"] > self.rows):
+            raise ValueError(f"The accumulator in {directory} does not match the output grid.")
+
+        with self._lock:
+            for row in range(0, band["rows"], block_size):
+                rows = slice(row, row + block_size)
+                target = slice(offset + row, offset + min(row + block_size, band["rows"]))
+                self.sums[:, target] += sums[:, rows]
+                self.weights[target] += weights[rows]
+
+    def flush(self, output_path, output: str = "class", block_size: int = 1024) -> None:
+        """
+        Writes the averaged predictions as a single GeoTIFF, block by block.
+
+        :param output_path: output GeoTIFF path
+        :param output: "class" writes the most likely class (uint8, nodata 255), "probability" writes the marsh
+            class probability (float32, nodata -1)
+        :param block_size: number of rows written per block
+        """
+        if output not in ("class", "probability"):
+            raise ValueError(f"Output type '{output}' is not valid.")
+
+        profile = self.profile.copy()
+        profile.update({
+            "driver": "GTiff",
+            "count": 1,
+            "dtype": "uint8" if output == "class" else "float32",
+            "nodata": 255 if output == "class" else -1,
+            "compress": "lzw",
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256
+        })
+        profile.pop("photometric", None)
+        profile.pop("interleave", None)
+
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for row_off in range(0, self.rows, block_size):
+                height = min(block_size, self.rows - row_off)
+                sums = self.sums[:, row_off:row_off + height]
+                weights = self.weights[row_off:row_off + height]
+                covered = weights > 0
+
+                if output == "class":
+                    block = np.argmax(sums, axis=0).astype("uint8")
+                else:
+                    block = sums[-1] / np.where(covered, weights, 1)
+                block[~covered] = profile["nodata"]
+
+                dst.write(block.astype(profile["dtype"]), 1, window=Window(0, self.row_off + row_off, self.width, height))
+
+        print(f"Accumulated predictions saved to: {output_path}")
+
+    def close(self) -> None:
+        """Releases the memory-mapped arrays and removes their backing files, unless a directory was given."""
+        if self.sums is not None:
+            self.sums.flush()
+            self.weights.flush()
+        self.sums = None
+        self.weights = None
+        if not self.keep:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Stitch multiple GeoTIFF patches into a single mosaic.")
     parser.add_argument("input_dir", type=str, help="Path to the directory containing GeoTIFF patches.")
     parser.add_argument("output_path", type=str, help="Output path for the stitched GeoTIFF.")
+    parser.add_argument("--chunked", action="store_true", help="Place the patches block by block with bounded open files.")
+    parser.add_argument("--block-size", type=int, default=2048, help="Number of output rows and columns per tile in chunked mode.")
+    parser.add_argument("--max-open-files", type=int, default=64, help="Maximum number of files opened at once in chunked mode.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes in chunked mode.")
 
     args = parser.parse_args()
 
-    stitch_tiff_patches(args.input_dir, args.output_path)
\ No newline at end of file
+    stitch_tiff_patches(args.input_dir, args.output_path, args.chunked, args.block_size, args.max_open_files, args.workers)
\ No newline at end of file
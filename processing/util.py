@@ -5,17 +5,39 @@
 import os
 import rasterio
 
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.warp import calculate_default_transform, transform_bounds, transform_geom, Resampling
 import fiona
 from rasterio.mask import mask
+from rasterio.features import bounds as geometry_bounds, geometry_mask
 from rasterio.windows import Window
 from tqdm import tqdm
 from rasterio.merge import merge
 from typing import Union, Tuple, List
 from pathlib import Path
 from rasterio.enums import Resampling as ResampleEnum
+from rasterio.transform import array_bounds, from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import bounds as window_bounds, from_bounds, transform as window_transform, WindowError
 import pandas as pd
 import numpy as np
+import math
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Single-file patch store written by split_and_save_patches(store="npy"), read by GenMARSH
+PATCH_STORE_ARRAY = "patches.npy"
+PATCH_STORE_META = "patches.json"
+PATCH_INDEX = "patch_index.csv"
+
+# Creation options of the tiled GeoTIFFs written block by block
+TILED_GTIFF_PROFILE = {
+    'driver': 'GTiff',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512,
+    'compress': 'lzw',
+    'interleave': 'pixel'
+}
 
 
 def find_img_data_folder(root_path):
@@ -41,37 +63,59 @@ def find_img_data_folder(root_path):
 
 
 
-def re_projection(intif, outtif, resampling_method=ResampleEnum.bilinear):
+def warp_blockwise(src, output_path, dst_crs, dst_transform, dst_width, dst_height,
+                   resampling_method=Resampling.bilinear, num_threads=None, warp_mem_limit=256):
+    """
+    Warp an open raster onto the target grid strip by strip, into a tiled and compressed GeoTIFF.
+
+    The source is read through a WarpedVRT using GDAL's multithreaded warper, so the memory use
+    is bounded by the warp buffer and a strip of output blocks whatever the raster size.
+
+    :param src: open source dataset
+    :param output_path: output GeoTIFF path
+    :param dst_crs: target CRS
+    :param dst_transform: target transform
+    :param dst_width: target width
+    :param dst_height: target height
+    :param resampling_method: resampling method
+    :param num_threads: number of warper threads, defaults to all CPUs
+    :param warp_mem_limit: warp buffer size in MB
+    """
+    profile = src.meta.copy()
+    profile.update(TILED_GTIFF_PROFILE)
+    profile.update({
+        'crs': dst_crs,
+        'transform': dst_transform,
+        'width': dst_width,
+        'height': dst_height
+    })
+
+    with WarpedVRT(src, crs=dst_crs, transform=dst_transform, width=dst_width, height=dst_height,
+                   resampling=resampling_method, warp_mem_limit=warp_mem_limit,
+                   warp_extras={'NUM_THREADS': num_threads or 'ALL_CPUS'}) as vrt:
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            strip_height = profile['blockysize']
+            for row_off in range(0, dst_height, strip_height):
+                window = Window(0, row_off, dst_width, min(strip_height, dst_height - row_off))
+                dst.write(vrt.read(window=window), window=window)
+
+
+def re_projection(intif, outtif, resampling_method=ResampleEnum.bilinear, num_threads=None, warp_mem_limit=256):
     """
     Image reprojection to project the raw imagery bands into WGS-84
 
     :param intif: input imagery path
     :param outtif: reprojected imagery
+    :param resampling_method: resampling method
+    :param num_threads: number of warper threads, defaults to all CPUs
+    :param warp_mem_limit: warp buffer size in MB
     :return:
     """
     dst_crs = 'EPSG:4326'
 
-    src = rasterio.open(intif, driver='JP2OpenJPEG')
-    transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
-    kwargs = src.meta.copy()
-    kwargs.update({
-        'crs': dst_crs,
-        'transform': transform,
-        'width': width,
-        'height': height,
-        'driver': 'GTiff'
-    })
-
-    with rasterio.open(outtif, 'w', **kwargs) as dst:
-        for i in range(1, src.count + 1):
-            reproject(
-                source=rasterio.band(src, i),
-                destination=rasterio.band(dst, i),
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=transform,
-                dst_crs=dst_crs,
-                resampling=resampling_method)
+    with rasterio.open(intif, driver='JP2OpenJPEG') as src:
+        transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+        warp_blockwise(src, outtif, dst_crs, transform, width, height, resampling_method, num_threads, warp_mem_limit)
 
 #
 #
@@ -136,7 +180,9 @@ def reproject_to_match(
     input_raster: Union[str, Path],
     output_raster: Union[str, Path],
     reference_raster: Union[str, Path],
-    resampling_method: Resampling = Resampling.bilinear
+    resampling_method: Resampling = Resampling.bilinear,
+    num_threads: int = None,
+    warp_mem_limit: int = 256
 ):
     """
     Reproject and resample an input raster to match the spatial resolution, transform,
@@ -152,6 +198,10 @@ def reproject_to_match(
         Path to the reference raster to match.
     resampling_method : rasterio.enums.Resampling
         Resampling method (nearest, bilinear, cubic, etc.).
+    num_threads : int, optional
+        Number of warper threads. Default is all CPUs.
+    warp_mem_limit : int, optional
+        Warp buffer size in MB. Default is 256.
     """
     with rasterio.open(reference_raster) as ref:
         dst_crs = ref.crs
@@ -160,33 +210,116 @@ def reproject_to_match(
         dst_height = ref.height
 
     with rasterio.open(input_raster) as src:
-        dst_profile = src.meta.copy()
-        dst_profile.update({
-            'crs': dst_crs,
-            'transform': dst_transform,
-            'width': dst_width,
-            'height': dst_height,
-            'driver': 'GTiff'
-        })
+        warp_blockwise(src, output_raster, dst_crs, dst_transform, dst_width, dst_height,
+                       resampling_method, num_threads, warp_mem_limit)
+
+
+def _reproject_granule_band(file, outfile, reference_path=None, num_threads=None):
+    """Reproject a granule band, to WGS-84 for the reference band or onto the grid of the reference band otherwise."""
+    print("Reproject file {}".format(file))
+    if reference_path is None:
+        re_projection(file, outfile, num_threads=num_threads)
+    else:
+        reproject_to_match(file, outfile, reference_path, num_threads=num_threads)
+    return outfile
+
 
-        with rasterio.open(output_raster, 'w', **dst_profile) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=dst_transform,
-                    dst_crs=dst_crs,
-                    resampling=resampling_method
-                )
+def _granule_key(band_path):
+    """Granule identifier of a band file, e.g. T18SVF_20180612T155901 for T18SVF_20180612T155901_B02_10m.jp2"""
+    stem = Path(band_path).stem
+    return stem[:stem.rindex('_B')]
 
 
-def merge_bands_to_multispectral(band_paths, output_path):
+def reproject_and_mosaic_bands(raw_data_path, band_list, res_list, reproject_path, mosaic_dir, year, workers=None):
+    """
+    Reproject every granule band and mosaic each band, scheduling the work across a process pool.
+
+    The reference band (the first one, B02) of every granule is reprojected first. As soon as it
+    finishes, the other bands of the same granule are fanned out onto its grid, and a band is
+    mosaicked as soon as all of its granules are reprojected.
+
+    :param raw_data_path: folder with the raw granule .jp2 bands
+    :param band_list: band names, the first one is the reference band
+    :param res_list: corresponding band resolutions
+    :param reproject_path: folder for the reprojected granule bands
+    :param mosaic_dir: folder for the band mosaics
+    :param year: imagery year, used in the mosaic names
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :return: list of band mosaic paths, in band order
+    """
+    band_granules = {
+        b: sorted(Path(raw_data_path).rglob("*B{}_{}m.jp2".format(b, res))) for b, res in zip(band_list, res_list)
+    }
+    proj_paths = {
+        b: {_granule_key(f): os.path.join(reproject_path, Path(f).stem + '_wgs84.tif') for f in files}
+        for b, files in band_granules.items()
+    }
+    mosaic_paths = {b: Path(mosaic_dir) / 'merge_B{}_{}.tif'.format(b, year) for b in band_list}
+    ref_band = band_list[0]
+
+    # Only the granules with a reference band can be reprojected
+    for b in band_list[1:]:
+        proj_paths[b] = {key: path for key, path in proj_paths[b].items() if key in proj_paths[ref_band]}
+
+    remaining = {b: set(paths) for b, paths in proj_paths.items()}
+    pending = {}
+
+    # Share the CPUs between the worker processes instead of running all-CPU warpers in each of them
+    workers = workers or os.cpu_count() or 1
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def band_done(b, key):
+            remaining[b].discard(key)
+            if not remaining[b]:
+                print("Mosaic band {}".format(b))
+                pending[executor.submit(create_mosaic, list(proj_paths[b].values()), mosaic_paths[b])] = ('mosaic', b, None)
+
+        def submit_band(b, file, key, reference_path=None):
+            outfile = proj_paths[b][key]
+            if os.path.isfile(outfile):
+                return False
+            pending[executor.submit(_reproject_granule_band, file, outfile, reference_path, num_threads)] = ('band', b, key)
+            return True
+
+        def fan_out(key):
+            reference_path = proj_paths[ref_band][key]
+            for b in band_list[1:]:
+                for file in band_granules[b]:
+                    if _granule_key(file) == key and not submit_band(b, file, key, reference_path):
+                        band_done(b, key)
+
+        # The reference band of every granule goes first
+        for file in band_granules[ref_band]:
+            key = _granule_key(file)
+            if not submit_band(ref_band, file, key):
+                band_done(ref_band, key)
+                fan_out(key)
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                task, b, key = pending.pop(future)
+                future.result()
+                if task == 'band':
+                    band_done(b, key)
+                    if b == ref_band:
+                        fan_out(key)
+
+    return [mosaic_paths[b] for b in band_list]
+
+
+def merge_bands_to_multispectral(band_paths, output_path, read_workers=1):
     """
     The raw imagery are downloaded as individual band, merge the band into a multisplectral imagery
+
+    The output is written block by block: for every internal block of the tiled, pixel-interleaved
+    output, the matching window is read from every band, so only one block per band is held in memory.
+
     :param band_paths: path to all band info
     :param output_path: output path
+    :param read_workers: number of threads reading the bands of a block in parallel
     :return:
     """
     # Open all the input bands
@@ -199,14 +332,25 @@ def merge_bands_to_multispectral(band_paths, output_path):
         assert b.crs == ref_profile['crs'], "Band CRS do not match"
         assert b.transform == ref_profile['transform'], "Band transforms do not match"
 
-    # Update the profile to write multiple bands
+    # Update the profile to write multiple bands into a tiled, pixel-interleaved output
     out_profile = ref_profile.copy()
+    out_profile.update(TILED_GTIFF_PROFILE)
     out_profile.update(count=len(band_data))
 
+    # Every thread reads a different band dataset, the datasets are never shared between threads
+    executor = ThreadPoolExecutor(max_workers=read_workers) if read_workers > 1 else None
+
     # Write to output file
     with rasterio.open(output_path, 'w', **out_profile) as dst:
-        for i, src in enumerate(band_data, start=1):
-            dst.write(src.read(1), i)
+        for _, window in tqdm(list(dst.block_windows(1)), desc="Stacking blocks"):
+            if executor is None:
+                block = [src.read(1, window=window) for src in band_data]
+            else:
+                block = list(executor.map(lambda src: src.read(1, window=window), band_data))
+            dst.write(np.stack(block), window=window)
+
+    if executor is not None:
+        executor.shutdown()
 
     # Close all band files
     for src in band_data:
@@ -214,6 +358,239 @@ def merge_bands_to_multispectral(band_paths, output_path):
 
     print(f"Combined TIFF written to: {output_path}")
 
+
+def warped_grid(granule_paths, dst_crs='EPSG:4326'):
+    """
+    Compute the output grid covering all granules in the target CRS, at the resolution GDAL picks
+    for the first granule (the same as re_projection).
+
+    :param granule_paths: list of granule band paths of the reference band (e.g. B02 10m)
+    :param dst_crs: target CRS
+    :return: transform, width and height of the output grid
+    """
+    res = None
+    granule_bounds = []
+    for path in granule_paths:
+        with rasterio.open(path) as src:
+            transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+        if res is None:
+            res = (transform.a, -transform.e)
+        granule_bounds.append(array_bounds(height, width, transform))  # (left, bottom, right, top)
+
+    left = min(b[0] for b in granule_bounds)
+    bottom = min(b[1] for b in granule_bounds)
+    right = max(b[2] for b in granule_bounds)
+    top = max(b[3] for b in granule_bounds)
+
+    width = int(math.ceil((right - left) / res[0]))
+    height = int(math.ceil((top - bottom) / res[1]))
+    return from_origin(left, top, res[0], res[1]), width, height
+
+
+def read_aoi_geometries(aoi_path, dst_crs='EPSG:4326'):
+    """
+    Read the AOI geometries of a .geojson or .shp file, in the target CRS
+
+    :param aoi_path: AOI file path
+    :param dst_crs: target CRS
+    :return: list of GeoJSON-like geometries and their bounds (left, bottom, right, top)
+    """
+    with fiona.open(aoi_path, "r") as shapefile:
+        geometries = [transform_geom(shapefile.crs_wkt, dst_crs, dict(feature["geometry"])) for feature in shapefile]
+
+    all_bounds = [geometry_bounds(geometry) for geometry in geometries]
+    aoi_bounds = (min(b[0] for b in all_bounds), min(b[1] for b in all_bounds),
+                  max(b[2] for b in all_bounds), max(b[3] for b in all_bounds))
+    return geometries, aoi_bounds
+
+
+def aoi_grid(transform, width, height, aoi_bounds):
+    """
+    Sub-grid of an output grid covering the AOI bounds, aligned on the pixels of the output grid so the
+    AOI imagery matches the full extent imagery pixel for pixel.
+
+    :return: transform, width and height of the AOI grid
+    """
+    inverse = ~transform
+    col_start, row_start = inverse * (aoi_bounds[0], aoi_bounds[3])
+    col_stop, row_stop = inverse * (aoi_bounds[2], aoi_bounds[1])
+
+    col_start, row_start = max(int(math.floor(col_start)), 0), max(int(math.floor(row_start)), 0)
+    col_stop, row_stop = min(int(math.ceil(col_stop)), width), min(int(math.ceil(row_stop)), height)
+
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    return window_transform(window, transform), int(window.width), int(window.height)
+
+
+def crop_to_aoi(tiff_path, aoi_path, output_path):
+    """
+    Crop an imagery to the AOI bounds block by block into a tiled output, setting the pixels outside the AOI
+    polygons to nodata. The AOI is reprojected to the CRS of the imagery; output_path may be tiff_path.
+
+    :param tiff_path: imagery to crop
+    :param aoi_path: AOI file path (.geojson or .shp)
+    :param output_path: output path
+    """
+    tmp_path = str(output_path) + ".tmp.tif"
+
+    with rasterio.open(tiff_path) as src:
+        geometries, aoi_bounds = read_aoi_geometries(aoi_path, src.crs)
+        transform, width, height = aoi_grid(src.transform, src.width, src.height, aoi_bounds)
+        col_off, row_off = ~src.transform * (transform.c, transform.f)
+        col_off, row_off = int(round(col_off)), int(round(row_off))
+        nodata = 0 if src.nodata is None else src.nodata
+
+        profile = src.profile.copy()
+        profile.update(TILED_GTIFF_PROFILE)
+        profile.update({
+            'transform': transform,
+            'width': width,
+            'height': height,
+            'nodata': nodata
+        })
+
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                src_window = Window(window.col_off + col_off, window.row_off + row_off, window.width, window.height)
+                block = src.read(window=src_window)
+                outside = geometry_mask(geometries, out_shape=block.shape[1:], transform=window_transform(window, transform))
+                block[:, outside] = nodata
+                dst.write(block, window=window)
+
+    os.replace(tmp_path, output_path)
+    print(f"Cropped image saved to: {output_path}")
+
+
+def aoi_source_window(src, aoi_bounds, aoi_crs='EPSG:4326'):
+    """
+    Window of a granule covering the AOI bounds, computed in the native CRS of the granule.
+
+    :return: the window, or None if the granule does not intersect the AOI
+    """
+    native_bounds = transform_bounds(aoi_crs, src.crs, *aoi_bounds, densify_pts=21)
+    try:
+        return from_bounds(*native_bounds, transform=src.transform).intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+
+
+def build_multispectral_stack(
+    band_granules: List[List[Union[str, Path]]],
+    output_path: Union[str, Path],
+    dst_crs: str = 'EPSG:4326',
+    resampling_method: Resampling = Resampling.bilinear,
+    num_threads: int = None,
+    warp_mem_limit: int = 256,
+    aoi_path: Union[str, Path] = None
+):
+    """
+    Warp, mosaic and stack the granule bands into the final multispectral imagery in a single pass.
+
+    Every granule band is warped on the fly onto the common output grid through a WarpedVRT, the
+    granules are mosaicked (first granule wins where both have data) and the bands are stacked
+    block by block, so no reprojected band or band mosaic is written to disk.
+
+    Parameters
+    ----------
+    band_granules : list of list of str or Path
+        For each output band (in band order), the paths of the raw granule .jp2 files. The first
+        band is the reference for the output grid and resolution, e.g. B02 at 10m.
+    output_path : str or Path
+        Path to save the multispectral imagery.
+    dst_crs : str
+        Target CRS. Default is 'EPSG:4326'.
+    resampling_method : rasterio.enums.Resampling
+        Resampling method (nearest, bilinear, cubic, etc.).
+    num_threads : int, optional
+        Number of warper threads. Default is all CPUs.
+    warp_mem_limit : int, optional
+        Warp buffer size in MB. Default is 256.
+    aoi_path : str or Path, optional
+        AOI boundary (.geojson or .shp). The output then only covers the AOI bounds, the granules not
+        intersecting the AOI are not opened, only the source pixels under the AOI are read and warped,
+        and the pixels outside the AOI polygons are set to nodata.
+    """
+    transform, width, height = warped_grid(band_granules[0], dst_crs)
+
+    # Open every granule band as a virtual warped dataset on the output grid
+    sources = [[rasterio.open(path) for path in paths] for paths in band_granules]
+
+    geometries = None
+    if aoi_path is not None:
+        geometries, aoi_bounds = read_aoi_geometries(aoi_path, dst_crs)
+        transform, width, height = aoi_grid(transform, width, height, aoi_bounds)
+
+        # Keep the granules intersecting the AOI, the intersection is computed in their native CRS
+        kept_sources = []
+        for band_srcs in sources:
+            kept = []
+            for src in band_srcs:
+                window = aoi_source_window(src, aoi_bounds, dst_crs)
+                if window is None:
+                    src.close()
+                else:
+                    kept.append(src)
+                    print(f"[INFO] {Path(src.name).name}: reading {window.width * window.height / (src.width * src.height) * 100:.1f}% of the granule")
+            kept_sources.append(kept)
+        sources = kept_sources
+
+        if not all(sources):
+            raise ValueError(f"No granule intersects the AOI for some bands: {aoi_path}")
+        print(f"[INFO] AOI grid: {width} x {height} pixels")
+
+    granule_bounds = [[transform_bounds(src.crs, dst_crs, *src.bounds) for src in band_srcs] for band_srcs in sources]
+    vrts = [
+        [WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height,
+                   resampling=resampling_method, src_nodata=0, nodata=0, warp_mem_limit=warp_mem_limit,
+                   warp_extras={'NUM_THREADS': num_threads or 'ALL_CPUS'}) for src in band_srcs]
+        for band_srcs in sources
+    ]
+
+    profile = TILED_GTIFF_PROFILE.copy()
+    profile.update({
+        'crs': dst_crs,
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'count': len(band_granules),
+        'dtype': sources[0][0].dtypes[0],
+        'nodata': 0
+    })
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        for _, window in tqdm(list(dst.block_windows(1)), desc="Stacking blocks"):
+            left, bottom, right, top = window_bounds(window, transform)
+            block = np.zeros((len(vrts), int(window.height), int(window.width)), dtype=profile['dtype'])
+
+            outside = None
+            if geometries is not None:
+                # Blocks entirely outside the AOI polygons are left as nodata without reading the granules
+                outside = geometry_mask(geometries, out_shape=block.shape[1:], transform=window_transform(window, transform))
+                if outside.all():
+                    dst.write(block, window=window)
+                    continue
+
+            for band_idx, (band_vrts, band_bounds) in enumerate(zip(vrts, granule_bounds)):
+                for vrt, g_bounds in zip(band_vrts, band_bounds):
+                    # Skip the granules that do not intersect the block
+                    if g_bounds[0] >= right or g_bounds[2] <= left or g_bounds[1] >= top or g_bounds[3] <= bottom:
+                        continue
+                    data = vrt.read(1, window=window)
+                    empty = block[band_idx] == 0
+                    block[band_idx][empty] = data[empty]
+
+            if outside is not None:
+                block[:, outside] = 0
+            dst.write(block, window=window)
+
+    for band_vrts, band_srcs in zip(vrts, sources):
+        for vrt, src in zip(band_vrts, band_srcs):
+            vrt.close()
+            src.close()
+
+    print(f"Combined TIFF written to: {output_path}")
+
+
 def upsample_raster(
     img_lres_path: Union[str, Path],
     img_hres_path: Union[str, Path],
@@ -340,7 +717,17 @@ def create_mosaic(proj_band_paths, mosaic_path):
 
 
 
-def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, bands=None, skip_partial=True, csv_filename ="patch_index.csv"):
+def valid_fraction(patch, nodata=None):
+    """
+    Fraction of the valid pixels of a patch (CxHxW): a pixel is invalid when all its bands are nodata (0 without
+    nodata), a single zero band (e.g. NIR over dark water) does not make it invalid.
+    """
+    invalid = (patch == (0 if nodata is None else nodata)).all(axis=0)
+    return 1.0 - float(invalid.mean())
+
+
+def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, bands=None, skip_partial=True, csv_filename=PATCH_INDEX, store="tif",
+                           min_valid_fraction=0.0, invalid_patches="skip"):
     """
     Create image patches for model training/inferencing
 
@@ -351,11 +738,23 @@ def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, ban
         overlap (int): Overlap between patches in pixels.
         bands (list or None): List of band indices to include (1-based). If None, includes all.
         skip_partial (bool): Skip patches that would go beyond image bounds.
+        csv_filename (str): Name of the patch index, listing the window offsets and geotransform of every patch.
+        store (str): "tif" saves every patch as its own GeoTIFF, "npy" saves all the patches into a single
+            memory-mappable array (PATCH_STORE_ARRAY, N x C x patch_size x patch_size, partial patches are
+            zero-padded) with the raster metadata in PATCH_STORE_META.
+        min_valid_fraction (float): Patches without valid pixels, or with a lower fraction of valid pixels
+            (see valid_fraction), are empty (e.g. ocean or outside the AOI).
+        invalid_patches (str): "skip" does not save the empty patches, "flag" saves them with valid=False in the
+            patch index, so the inference skips them either way.
     """
+    if store not in ("tif", "npy"):
+        raise ValueError(f"Patch store '{store}' is not valid.")
+    if invalid_patches not in ("skip", "flag"):
+        raise ValueError(f"Invalid patch handling '{invalid_patches}' is not valid.")
+
     os.makedirs(output_dir, exist_ok=True)
     csv_path = Path(output_dir) / csv_filename
-    patch_names = []
-    patch_paths = []
+    records = []
 
     with rasterio.open(input_tif) as src:
         img_width = src.width
@@ -363,12 +762,12 @@ def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, ban
         total_bands = src.count if bands is None else len(bands)
 
         step = patch_size - overlap
-        count = 0
 
         col_steps = range(0, img_width - (patch_size if skip_partial else 0) + 1, step)
         row_steps = range(0, img_height - (patch_size if skip_partial else 0) + 1, step)
 
-        for top in tqdm(row_steps, desc="Processing rows"):
+        windows = []
+        for top in row_steps:
             for left in col_steps:
                 win_width = min(patch_size, img_width - left)
                 win_height = min(patch_size, img_height - top)
@@ -376,39 +775,79 @@ def split_and_save_patches(input_tif, output_dir, patch_size=256, overlap=0, ban
                 if skip_partial and (win_width < patch_size or win_height < patch_size):
                     continue
 
-                window = Window(left, top, win_width, win_height)
-                transform = src.window_transform(window)
-
-                # Read only selected bands and window
-                patch = src.read(indexes=bands, window=window) if bands else src.read(window=window)
-
+                windows.append(Window(left, top, win_width, win_height))
+
+        if store == "npy":
+            array_path = Path(output_dir) / PATCH_STORE_ARRAY
+            patch_store = np.lib.format.open_memmap(array_path, mode="w+", dtype=src.dtypes[0],
+                                                    shape=(len(windows), total_bands, patch_size, patch_size))
+            with open(Path(output_dir) / PATCH_STORE_META, "w") as f:
+                json.dump({
+                    "source": str(Path(input_tif).resolve()),
+                    "crs": src.crs.to_wkt() if src.crs else None,
+                    "dtype": src.dtypes[0],
+                    "count": total_bands,
+                    "nodata": src.nodata,
+                    "patch_size": patch_size
+                }, f, indent=2)
+
+        skipped = 0
+        for count, window in enumerate(tqdm(windows, desc="Processing patches")):
+            transform = src.window_transform(window)
+
+            # Read only selected bands and window
+            patch = src.read(indexes=bands, window=window) if bands else src.read(window=window)
+
+            fraction = valid_fraction(patch, src.nodata)
+            valid = fraction > 0 and fraction >= min_valid_fraction
+            if not valid and invalid_patches == "skip":
+                skipped += 1
+                continue
+
+            patch_filename = f"patch_{count:05d}.tif"
+
+            if store == "npy":
+                # The rows of the store follow the rows of the patch index, the skipped patches leave no gap
+                patch_store[len(records), :, :patch.shape[1], :patch.shape[2]] = patch
+                patch_path = array_path
+            else:
                 meta = src.meta.copy()
                 meta.update({
                     "driver": "GTiff",
-                    "height": win_height,
-                    "width": win_width,
+                    "height": window.height,
+                    "width": window.width,
                     "transform": transform,
                     "count": total_bands
                 })
 
-                patch_filename = f"patch_{count:05d}.tif"
                 patch_path = os.path.join(output_dir, patch_filename)
                 with rasterio.open(patch_path, 'w', **meta) as dst:
                     dst.write(patch)
 
-                patch_names.append(patch_filename)
-                patch_paths.append(str(Path(patch_path).resolve()))
-
-                count += 1
+            records.append({
+                "patch_name": patch_filename,
+                "patch_path": str(Path(patch_path).resolve()),
+                "col_off": window.col_off,
+                "row_off": window.row_off,
+                "width": window.width,
+                "height": window.height,
+                "transform": ",".join(str(v) for v in tuple(transform)[:6]),
+                "valid_fraction": round(fraction, 4),
+                "valid": valid
+            })
+
+        if store == "npy":
+            patch_store.flush()
+            del patch_store
 
     # Create DataFrame
-    df = pd.DataFrame({
-        "patch_name": patch_names,
-        "patch_path": patch_paths
-    })
+    df = pd.DataFrame(records, columns=["patch_name", "patch_path", "col_off", "row_off", "width", "height", "transform",
+                                        "valid_fraction", "valid"])
 
     df.to_csv(csv_path, index=False)
-    print(f"{count} patches saved to {output_dir}")
+    print(f"{len(records)} patches saved to {output_dir}")
+    if skipped:
+        print(f"{skipped} empty patches (valid fraction below {min_valid_fraction}) skipped")
 
 
 
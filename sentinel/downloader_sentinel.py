@@ -1,22 +1,27 @@
 
 
 import os
-import boto3
 import geopandas as gpd
+from shapely.geometry import shape
 from pystac_client import Client
 from typing import Tuple, List
 import pandas as pd
 from pathlib import Path
 
+from stac_cache import StacSearchCache
+from granule_selection import select_granules, print_coverage_report, save_coverage_report
+from transfer import TransferEngine
+
 # -------- Configuration -------- #
 STAC_URL = "https://catalogue.dataspace.copernicus.eu/stac" # for data filtering
-ENDPOINT_URL = "https://eodata.dataspace.copernicus.eu" # for data download
+# for data download, S3_ENDPOINT_URL points the downloader to another S3 endpoint (e.g. a local S3 stand-in for testing)
+ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "https://eodata.dataspace.copernicus.eu")
 
 # -------- Replace your access key an secret key from https://dataspace.copernicus.eu/ --------
 # More info: https://documentation.dataspace.copernicus.eu/APIs/OData.html#product-download
 
-ACCESS_KEY = ""
-SECRET_KEY = ""
+ACCESS_KEY = os.environ.get("S3_ACCESS_KEY", "")
+SECRET_KEY = os.environ.get("S3_SECRET_KEY", "")
 
 project_root = Path(__file__).resolve().parent.parent
 AOI_PATH = os.path.join(project_root, 'dataset/raw/guinea_marsh.geojson')
@@ -27,10 +32,27 @@ MAX_CLOUD_COVER = 3
 START_DATE = "2018-05-01"
 END_DATE = "2018-10-30"
 
+# Only the bands used by processing/preprocessing_sentinel.py (band_list/res_list) are downloaded,
+# set to None to download the whole .SAFE product
+BAND_LIST = ["02", "03", "04", "05", "06", "07", "08", "8A", "11", "12"]
+RES_LIST = ["10", "10", "10", "20", "20", "20", "10", "20", "20", "20"]
+
 
 # AOI_PATH = "../boundary.geojson"
 OUTPUT_DIR = os.path.join(project_root, 'dataset/raw')
 DATA_META = "sentinel2_meta.csv"
+COVERAGE_REPORT = "sentinel2_coverage.json"
+
+# STAC search results are cached on disk, a repeated search within STAC_CACHE_TTL seconds does not query the
+# catalogue; an expired entry is still used when the catalogue cannot be reached
+STAC_CACHE_DIR = os.path.join(OUTPUT_DIR, '.stac_cache')
+STAC_CACHE_TTL = 7 * 24 * 3600
+
+# Extra cost of cloudy granules in the granule selection, a 100% cloudy granule costs (1 + CLOUD_PENALTY) times its size
+CLOUD_PENALTY = 2.0
+
+# Number of objects downloaded at the same time, across all the products
+MAX_TRANSFERS = 8
 
 
 def get_url_parts(url: str) -> Tuple[str, str]:
@@ -39,18 +61,38 @@ def get_url_parts(url: str) -> Tuple[str, str]:
     return bucket, path
 
 
-def download_s3_product(bucket, product_prefix: str, target_dir: str = "") -> None:
-    """Download all files under a prefix from a public S3 bucket."""
-    files = bucket.objects.filter(Prefix=product_prefix)
-    if not list(files):
+def is_product_metadata(key: str) -> bool:
+    """Product and granule metadata of a .SAFE product (manifest.safe, MTD_MSIL2A.xml, MTD_TL.xml, ...)."""
+    name = key.rsplit("/", 1)[-1]
+    return name == "manifest.safe" or (name.startswith("MTD_") and name.endswith(".xml"))
+
+
+def select_product_files(files: list, bands: List[str] = None, resolutions: List[str] = None) -> list:
+    """
+    Keep the JP2 images of the requested bands at the requested resolutions (e.g. B02 at 10 m is
+    ..._B02_10m.jp2), plus the product metadata. All files are kept if bands is None.
+    """
+    if bands is None:
+        return files
+
+    suffixes = tuple(f"_B{band}_{res}m.jp2" for band, res in zip(bands, resolutions))
+    return [file for file in files if file.key.endswith(suffixes) or is_product_metadata(file.key)]
+
+
+def download_s3_product(engine: TransferEngine, bucket: str, product_prefix: str, bands: List[str] = None,
+                        resolutions: List[str] = None) -> None:
+    """Queue the download of the files under a prefix of an S3 bucket, only the requested bands if bands is given."""
+    all_files = engine.list_objects(bucket, product_prefix)
+    if not all_files:
         raise FileNotFoundError(f"No files found for product: {product_prefix}")
 
-    for file in files:
-        local_path = os.path.join(target_dir, file.key)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        if not os.path.isdir(local_path):
-            print(f"Downloading: {file.key}")
-            bucket.download_file(file.key, local_path)
+    files = select_product_files(all_files, bands, resolutions)
+    total_size = sum(file.size for file in all_files)
+    selected_size = sum(file.size for file in files)
+    print(f"Selected {len(files)} of {len(all_files)} files, {selected_size / 2 ** 20:.1f} of "
+          f"{total_size / 2 ** 20:.1f} MB ({selected_size / max(total_size, 1) * 100:.1f}%)")
+
+    engine.submit(bucket, files)
 
 
 def get_aoi_bbox(aoi_file: str) -> List[float]:
@@ -64,19 +106,63 @@ def get_aoi_bbox(aoi_file: str) -> List[float]:
     return gdf.total_bounds.tolist()
 
 
-def search_sentinel_items(client: Client, bbox: List[float], start: str, end: str, cloud_cover: int, product_type: str) -> List:
-    """Search STAC for Sentinel items with filters."""
-    results = client.search(
-        collections=[DATA_COLLECTION],
-        bbox=bbox,
-        datetime=f"{start}/{end}"
-    )
-    # return [item for item in results.items()]
-    return [
-        item for item in results.items()
-        if item.properties.get("cloudCover", 100) <= cloud_cover and
-           item.properties.get("productType", "").upper() == product_type.upper()
-    ]
+def get_aoi_geometry(aoi_file: str):
+    """Get the union of the AOI geometries, in EPSG:4326"""
+    gdf = gpd.read_file(aoi_file).to_crs("EPSG:4326")
+    return gdf.geometry.unary_union
+
+
+def filter_items_by_aoi(items: list, aoi_geometry) -> list:
+    """Drop the items whose footprint does not intersect the AOI geometry (not just its bounding box)."""
+    kept = [item for item in items if item.geometry and shape(item.geometry).intersects(aoi_geometry)]
+    print(f"{len(kept)} of {len(items)} items intersect the AOI")
+    return kept
+
+
+def matches_filters(item, cloud_cover: int, product_type: str) -> bool:
+    return (item.properties.get("cloudCover", 100) <= cloud_cover and
+            item.properties.get("productType", "").upper() == product_type.upper())
+
+
+def search_sentinel_items(bbox: List[float], start: str, end: str, cloud_cover: int, product_type: str,
+                          cache: StacSearchCache = None) -> List:
+    """
+    Search STAC for Sentinel items with filters. The cloud cover and product type filters are sent with the
+    request (STAC query extension) and the results are read page by page; the client-side check only guards
+    against catalogues ignoring the query. The results are served from the cache when available.
+    """
+    params = {
+        "collections": [DATA_COLLECTION],
+        "bbox": [round(value, 6) for value in bbox],
+        "datetime": f"{start}/{end}",
+        "query": {"cloudCover": {"lte": cloud_cover}, "productType": {"eq": product_type}}
+    }
+    key = StacSearchCache.key(url=STAC_URL, **params)
+
+    if cache is not None:
+        items = cache.get(key)
+        if items is not None:
+            return items
+
+    try:
+        results = Client.open(STAC_URL).search(**params)
+        items = []
+        for page_idx, page in enumerate(results.pages()):
+            page_items = [item for item in page if matches_filters(item, cloud_cover, product_type)]
+            items.extend(page_items)
+            print(f"Page {page_idx + 1}: {len(page_items)} of {len(page)} items kept")
+    except Exception as e:
+        # Offline: fall back to an expired cache entry
+        items = cache.get(key, allow_stale=True) if cache is not None else None
+        if items is None:
+            raise
+        print(f"[WARN] STAC search failed ({e}), using the cached results")
+        return items
+
+    if cache is not None:
+        cache.put(key, params, items)
+    return items
+
 
 def metadata_generation(items: list):
     # Extract the properties dict from each item in the items list
@@ -93,52 +179,49 @@ def metadata_generation(items: list):
     return df
 
 
-def set_download_granules(df: pd.DataFrame, error_item=None):
-    df["downloaded"] = 0
-
-    # Sort by tileid and cloud_cover
-    df = df.sort_values(by=['tileId', 'cloudCover'])
-
-    # For each tileid, set downloaded = 1 for the first (lowest cloud cover) row
-    df.loc[df.groupby('tileId').head(1).index, 'downloaded'] = 1
-
-    # if error_item is not None: # set not downloadable tiles
-    #     df.loc[df.item == error_item, "downloaded"] = -1
-    #
-    # for i in set(df["tileId"].to_list()):
-    #     print(i)
-    #     best_item = df.loc[(df.tileId == i) & (df.downloaded != -1)].sort_values("cloudCover").iloc[0].granuleIdentifier
-    #     df.loc[df.granuleIdentifier == best_item, "downloaded"] = 1
+def set_download_granules(df: pd.DataFrame, aoi_geometry, output: str = OUTPUT_DIR):
+    """
+    Mark the granules to download: the cheapest combination of footprints (in bytes, penalised by cloud cover)
+    covering the AOI, see granule_selection.select_granules. The coverage report is saved next to the metadata.
+    """
+    df, report = select_granules(df, aoi_geometry, cloud_penalty=CLOUD_PENALTY)
+    print_coverage_report(report)
+    save_coverage_report(report, os.path.join(output, COVERAGE_REPORT))
     return df
 
 
-def download_all(items:list, output):
+def download_all(items:list, output, bands: List[str] = None, resolutions: List[str] = None,
+                 max_transfers: int = MAX_TRANSFERS):
+    """
+    Download the products of all items through one transfer engine: the files of all the products share
+    a pooled S3 client and are downloaded concurrently. Completed files are skipped and partial files
+    resumed, so an interrupted download can simply be restarted.
+    """
+    engine = TransferEngine(output, ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, max_workers=max_transfers)
 
-    for idx, item in enumerate(items):
+    try:
+        for idx, item in enumerate(items):
 
-        print(f"\nProcessing item {idx + 1} of {len(items)}")
+            print(f"\nProcessing item {idx + 1} of {len(items)}")
 
-        safe_asset = item.assets.get("PRODUCT").to_dict().get("alternate", {}).get("s3")
+            safe_asset = item.assets.get("PRODUCT").to_dict().get("alternate", {}).get("s3")
 
-        if not safe_asset:
-            print("Downloadable asset not found in STAC metadata.")
-            return
+            if not safe_asset:
+                print("Downloadable asset not found in STAC metadata.")
+                continue
 
-        print("Found downloadable product. Connecting to S3...")
-        session = boto3.session.Session()
-        s3 = session.resource(
-            's3',
-            endpoint_url=ENDPOINT_URL,
-            aws_access_key_id=ACCESS_KEY,
-            aws_secret_access_key=SECRET_KEY,
-            region_name='default'
-        )
+            bucket_name, product_path = get_url_parts(safe_asset["href"])
+            print(f"Downloading path: {product_path}")
 
-        bucket_name, product_path = get_url_parts(safe_asset["href"])
-        print(f"Downloading path: {product_path}")
+            download_s3_product(engine, bucket_name, product_path, bands=bands, resolutions=resolutions)
 
-        download_s3_product(s3.Bucket(bucket_name), product_path, target_dir=output)
-        print(f"Download completed! Files saved to: {OUTPUT_DIR}")
+        summary = engine.wait()
+    finally:
+        engine.close()
+
+    if summary["failed"]:
+        print(f"{summary['failed']} files failed, run the downloader again to resume them.")
+    print(f"Download completed! Files saved to: {output}")
 
 # -------- Main Process -------- #
 
@@ -147,16 +230,20 @@ def main():
     if not ACCESS_KEY or not SECRET_KEY:
         raise("Fill the ACCESS KEY and SECRET KEY")
 
-    client = Client.open(STAC_URL)
     bbox = get_aoi_bbox(AOI_PATH)
 
     print(f"Searching Sentinel-2 imagery ({START_DATE} to {END_DATE}) with cloud cover <={MAX_CLOUD_COVER}%")
-    items = search_sentinel_items(client, bbox, START_DATE, END_DATE, MAX_CLOUD_COVER, PRODUCT_TYPE) # Get all items that matched the filter criteria
+    cache = StacSearchCache(STAC_CACHE_DIR, ttl=STAC_CACHE_TTL)
+    items = search_sentinel_items(bbox, START_DATE, END_DATE, MAX_CLOUD_COVER, PRODUCT_TYPE, cache) # Get all items that matched the filter criteria
+
+    # The bbox search also returns granules that only touch the bbox, not the AOI itself
+    aoi_geometry = get_aoi_geometry(AOI_PATH)
+    items = filter_items_by_aoi(items, aoi_geometry)
 
     print("Generating download tiles list....")
-    # Pick up non repeatable tiles and download
+    # Pick up the granules covering the AOI at the lowest cost and download
     df = metadata_generation(items)
-    df = set_download_granules(df)
+    df = set_download_granules(df, aoi_geometry)
     df.to_csv(os.path.join(OUTPUT_DIR, DATA_META))
 
     download_items = df.loc[df.downloaded == 1]['item'].tolist()
@@ -166,7 +253,7 @@ def main():
         return
 
     print("Start downloading {} of tiles...".format(len(download_items)))
-    download_all(download_items, OUTPUT_DIR)
+    download_all(download_items, OUTPUT_DIR, BAND_LIST, RES_LIST)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+import json
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+# Size of a Level-2A product when the STAC item does not report it
+DEFAULT_PRODUCT_BYTES = 800 * 2 ** 20
+
+# Extra cost of a fully cloudy granule, relative to its size: with 2, a 100% cloudy granule costs as
+# much as three clear granules of the same size
+CLOUD_PENALTY = 2.0
+
+
+def product_bytes(item) -> int:
+    """Size of the product of a STAC item, from the file:size of its PRODUCT asset when available."""
+    asset = item.assets.get("PRODUCT")
+    size = asset.extra_fields.get("file:size") if asset is not None else None
+    return int(size) if size else DEFAULT_PRODUCT_BYTES
+
+
+def granule_cost(size: int, cloud_cover: float, cloud_penalty: float = CLOUD_PENALTY) -> float:
+    return size * (1 + cloud_penalty * cloud_cover / 100)
+
+
+def select_granules(df: pd.DataFrame, aoi_geometry, cloud_penalty: float = CLOUD_PENALTY, tolerance: float = 1e-3):
+    """
+    Choose the granules to download as a weighted set cover of the AOI: greedily add the granule covering
+    the most uncovered AOI area per unit of cost (bytes weighted by the cloud cover), until the uncovered
+    area is below tolerance of the AOI, then drop the selected granules made redundant by later ones.
+    Partial granules of different orbits are combined when they cover the AOI more cheaply than a full tile.
+
+    :param df: one row per STAC item, with the item and its cloudCover (see metadata_generation)
+    :param aoi_geometry: AOI geometry in EPSG:4326
+    :param tolerance: fraction of the AOI that may stay uncovered, also the smallest useful coverage gain
+    :return: df with the bytes, cost, aoi_fraction and downloaded columns, and the coverage report
+    """
+    df = df.copy()
+
+    # Areas are measured in the UTM zone of the AOI
+    aoi = gpd.GeoSeries([aoi_geometry], crs="EPSG:4326")
+    crs = aoi.estimate_utm_crs()
+    aoi = aoi.to_crs(crs).iloc[0]
+    aoi_area = aoi.area
+
+    # Only the part of each footprint over the AOI matters
+    footprints = gpd.GeoSeries([shape(item.geometry) for item in df["item"]], crs="EPSG:4326")
+    footprints = footprints.to_crs(crs).intersection(aoi).values
+
+    cloud_cover = df["cloudCover"].fillna(100).to_numpy() if "cloudCover" in df.columns else [100] * len(df)
+    sizes = [product_bytes(item) for item in df["item"]]
+    costs = [granule_cost(size, cloud, cloud_penalty) for size, cloud in zip(sizes, cloud_cover)]
+
+    tree = STRtree(footprints)
+    min_gain = tolerance * aoi_area
+    uncovered = aoi
+    selected = []
+
+    while uncovered.area > min_gain:
+        gains = {}
+        for index in tree.query(uncovered, predicate="intersects"):
+            if index not in selected:
+                gain = footprints[index].intersection(uncovered).area
+                if gain > min_gain:
+                    gains[index] = gain
+        if not gains:
+            break
+
+        best = max(gains, key=lambda index: gains[index] / costs[index])
+        selected.append(best)
+        uncovered = uncovered.difference(footprints[best])
+
+    # A granule picked early can be covered by the ones picked after it, drop the most expensive first
+    for index in sorted(selected, key=lambda index: -costs[index]):
+        others = shapely.union_all([footprints[other] for other in selected if other != index])
+        if footprints[index].difference(others).area <= min_gain:
+            selected.remove(index)
+
+    df["bytes"] = sizes
+    df["cost"] = costs
+    df["aoi_fraction"] = [footprint.area / aoi_area for footprint in footprints]
+    df["downloaded"] = 0
+    df.iloc[selected, df.columns.get_loc("downloaded")] = 1
+
+    covered = shapely.union_all([footprints[index] for index in selected]).area if selected else 0.0
+    report = {
+        "aoi_area_km2": aoi_area / 1e6,
+        "covered_fraction": covered / aoi_area,
+        "candidates": len(df),
+        "selected_bytes": int(sum(sizes[index] for index in selected)),
+        "selected": [
+            {
+                "granule": df["granuleIdentifier"].iloc[index] if "granuleIdentifier" in df.columns else df["item"].iloc[index].id,
+                "tileId": df["tileId"].iloc[index] if "tileId" in df.columns else None,
+                "cloudCover": float(cloud_cover[index]),
+                "bytes": sizes[index],
+                "aoi_fraction": df["aoi_fraction"].iloc[index]
+            }
+            for index in selected
+        ]
+    }
+
+    # Size of the former selection, the lowest cloud cover granule of every tile, for comparison
+    if "tileId" in df.columns:
+        per_tile = df.assign(cloudCover=cloud_cover).sort_values(["tileId", "cloudCover"]).groupby("tileId").head(1)
+        report["per_tile_bytes"] = int(per_tile["bytes"].sum())
+
+    return df, report
+
+
+def print_coverage_report(report: dict) -> None:
+    print(f"Selected {len(report['selected'])} of {report['candidates']} granules "
+          f"({report['selected_bytes'] / 2 ** 20:.0f} MB), covering {report['covered_fraction'] * 100:.2f}% "
+          f"of the {report['aoi_area_km2']:.1f} km2 AOI")
+    if "per_tile_bytes" in report:
+        print(f"The lowest cloud cover granule per tile would be {report['per_tile_bytes'] / 2 ** 20:.0f} MB")
+    for granule in report["selected"]:
+        print(f"  {granule['granule']}: {granule['aoi_fraction'] * 100:.1f}% of the AOI, "
+              f"{granule['cloudCover']:.1f}% cloud cover")
+
+
+def save_coverage_report(report: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Coverage report saved to: {path}")
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+import time
+
+from pystac import Item
+
+
+class StacSearchCache:
+    """
+    On-disk cache of STAC search results, one JSON file of item dictionaries per search. A search is identified
+    by its parameters (bbox, datetime, filters), entries older than ttl seconds are stale.
+
+    :param cache_dir: folder of the cached searches
+    :param ttl: lifetime of an entry in seconds
+    """
+
+    def __init__(self, cache_dir: str, ttl: float = 7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**params) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str, allow_stale: bool = False):
+        """Cached items of a search, None if it is not cached or stale (unless allow_stale)."""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as f:
+            entry = json.load(f)
+
+        age = time.time() - entry["created"]
+        if age > self.ttl and not allow_stale:
+            return None
+
+        print(f"[INFO] Using {len(entry['items'])} cached STAC items ({age / 3600:.1f} h old)")
+        return [Item.from_dict(item) for item in entry["items"]]
+
+    def put(self, key: str, params: dict, items: list) -> None:
+        path = self.path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"created": time.time(), "params": params, "items": [item.to_dict() for item in items]}, f,
+                      default=str)
+        os.replace(tmp_path, path)
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+from botocore.config import Config
+
+# Object listed under a product prefix
+S3Object = namedtuple("S3Object", ["key", "size", "etag"])
+
+TRANSFER_STATE = ".transfer_state.json"
+TRANSFER_REPORT = "transfer_report.json"
+
+
+class TransferEngine:
+    """
+    Concurrent, resumable S3 downloader shared by all the products of a run.
+
+    One pooled S3 client serves a bounded pool of threads downloading objects across products. Large objects
+    are split into byte ranges downloaded in parallel into a .part file; the completed ranges are recorded
+    next to it, so an interrupted download resumes where it stopped. Completed files are skipped when their
+    size matches the object, and their ETag when it was recorded by a previous run.
+
+    :param output_dir: root folder of the downloads
+    :param endpoint_url: S3 endpoint, e.g. a local S3 emulator for testing
+    :param max_workers: number of objects downloaded at the same time
+    :param part_size: size of the byte ranges of the large objects
+    :param multipart_threshold: objects from this size are downloaded in ranges
+    """
+
+    def __init__(self, output_dir: str, endpoint_url: str, access_key: str, secret_key: str, max_workers: int = 8,
+                 part_size: int = 16 * 2 ** 20, multipart_threshold: int = 32 * 2 ** 20):
+        self.output_dir = output_dir
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+
+        # The connection pool is shared by the object and the range threads
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name='default',
+            config=Config(max_pool_connections=2 * max_workers, retries={"max_attempts": 10, "mode": "adaptive"})
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.range_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+        self.state_path = os.path.join(output_dir, TRANSFER_STATE)
+        self.state = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+        self.records = []
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def list_objects(self, bucket: str, prefix: str) -> list:
+        """Lists the objects under a prefix in a single pass over the result pages."""
+        objects = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                objects.append(S3Object(obj["Key"], obj["Size"], obj["ETag"]))
+        return objects
+
+    def submit(self, bucket: str, objects: list) -> None:
+        """Queues the download of objects, keeping their key as path under output_dir."""
+        for obj in objects:
+            self.futures.append(self.executor.submit(self.download_object, bucket, obj))
+
+    def is_complete(self, obj: S3Object, local_path: str) -> bool:
+        if not os.path.isfile(local_path) or os.path.getsize(local_path) != obj.size:
+            return False
+        recorded = self.state.get(obj.key)
+        return recorded is None or recorded == obj.etag
+
+    def download_object(self, bucket: str, obj: S3Object) -> dict:
+        local_path = os.path.join(self.output_dir, obj.key)
+        record = {"key": obj.key, "size": obj.size, "bytes": 0, "seconds": 0.0}
+        start = time.perf_counter()
+
+        try:
+            if self.is_complete(obj, local_path):
+                record["status"] = "skipped"
+            else:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                print(f"Downloading: {obj.key}")
+                record["bytes"] = self.download_ranges(bucket, obj, local_path)
+                record["status"] = "downloaded"
+                with self._lock:
+                    self.state[obj.key] = obj.etag
+        except Exception as e:
+            print(f"[WARN] Failed to download {obj.key}: {e}")
+            record.update({"status": "failed", "error": str(e)})
+
+        record["seconds"] = time.perf_counter() - start
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def download_ranges(self, bucket: str, obj: S3Object, local_path: str) -> int:
+        """
+        Downloads an object in byte ranges into local_path.part, skipping the ranges completed by an earlier
+        attempt on the same object version, then moves it into place. Returns the number of bytes transferred.
+        """
+        part_path = local_path + ".part"
+        progress_path = part_path + ".json"
+
+        part_size = self.part_size if obj.size >= self.multipart_threshold else max(obj.size, 1)
+        ranges = [(start, min(start + part_size, obj.size) - 1) for start in range(0, obj.size, part_size)]
+
+        done = []
+        if os.path.isfile(part_path) and os.path.isfile(progress_path):
+            with open(progress_path) as f:
+                progress = json.load(f)
+            if progress["etag"] == obj.etag and progress["part_size"] == part_size:
+                done = progress["done"]
+        if not done:
+            with open(part_path, "wb") as f:
+                f.truncate(obj.size)
+
+        lock = threading.Lock()
+
+        def fetch(index):
+            start, end = ranges[index]
+            # IfMatch: fails if the object changed since it was listed, instead of mixing two versions
+            response = self.client.get_object(Bucket=bucket, Key=obj.key, Range=f"bytes={start}-{end}", IfMatch=obj.etag)
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                for chunk in response["Body"].iter_chunks(2 ** 20):
+                    f.write(chunk)
+
+            with lock:
+                done.append(index)
+                with open(progress_path, "w") as f:
+                    json.dump({"etag": obj.etag, "part_size": part_size, "done": done}, f)
+            return end - start + 1
+
+        completed = set(done)
+        missing = [index for index in range(len(ranges)) if index not in completed]
+        if len(missing) == 1:
+            transferred = fetch(missing[0])
+        else:
+            transferred = sum(future.result() for future in [self.range_executor.submit(fetch, i) for i in missing])
+
+        os.replace(part_path, local_path)
+        if os.path.isfile(progress_path):
+            os.remove(progress_path)
+        return transferred
+
+    def wait(self) -> dict:
+        """Waits for the queued downloads, saves the completed ETags and writes the transfer report."""
+        wait(self.futures)
+        self.futures = []
+
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f)
+
+        return self.write_report()
+
+    def write_report(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        transferred = sum(record["bytes"] for record in self.records)
+        summary = {
+            "objects": len(self.records),
+            "downloaded": sum(record["status"] == "downloaded" for record in self.records),
+            "skipped": sum(record["status"] == "skipped" for record in self.records),
+            "failed": sum(record["status"] == "failed" for record in self.records),
+            "bytes": transferred,
+            "seconds": elapsed,
+            "mb_per_second": transferred / 2 ** 20 / max(elapsed, 1e-9)
+        }
+
+        report_path = os.path.join(self.output_dir, TRANSFER_REPORT)
+        with open(report_path, "w") as f:
+            json.dump({"summary": summary, "objects": self.records}, f, indent=2)
+
+        print(f"Transferred {transferred / 2 ** 20:.1f} MB in {elapsed:.1f}s ({summary['mb_per_second']:.1f} MB/s): "
+              f"{summary['downloaded']} downloaded, {summary['skipped']} skipped, {summary['failed']} failed")
+        print(f"Transfer report saved to: {report_path}")
+        return summary
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.range_executor.shutdown()